@@ -1,8 +1,15 @@
 from ._parser import ApricotParser
 from ._request import ApricotRequest
+from ._body import ApricotRequestBody, ApricotBodyTooLarge
 from ._response import ApricotResponse
-from ._protocol import ApricotProtocol
+from ._protocol import ApricotProtocol, ApricotResponseError
 from ._response import ApricotHttpResponse
+from ._response import ApricotStreamResponse
+from ._response import ApricotFileResponse
 
 from ._client import ApricotClient
-from ._session import ApricotSession
\ No newline at end of file
+from ._connection import ApricotConnection
+from ._session import ApricotSession
+from ._pool import ApricotConnectionPool, ApricotPoolClosed
+from ._tls import ApricotTLS, ApricotSSLContext
+from ._resolver import ApricotResolver, ApricotDNSCache
\ No newline at end of file
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+#! python3
+
+import asyncio
+from collections import deque
+
+class ApricotBodyTooLarge(Exception): pass
+
+class ApricotRequestBody(object):
+	''' Request body fed by a connection and read by a handler
+
+	Chunks are queued as they arrive. Once more than high_water bytes are
+	waiting, pause() is called so the connection stops reading from the
+	socket, resume() follows when the handler has caught up.
+	'''
+
+	high_water = 256 * 1024
+
+	def __init__(self, limit=None, on_start=None, pause=None, resume=None):
+		self.limit     = limit
+		self.on_start  = on_start
+		self.pause     = pause
+		self.resume    = resume
+		self.buffer    = deque()
+		self.buffered  = 0
+		self.received  = 0
+		self.eof       = False
+		self.exception = None
+		self.started   = False
+		self.paused    = False
+		self.waiter    = None
+
+	def start(self):
+		''' called before the first read, e.g. to send 100 Continue '''
+		if not self.started:
+			self.started = True
+			if self.on_start is not None:
+				self.on_start()
+
+	##### Connection side #####
+
+	def feed_data(self, data):
+		if self.exception is not None:
+			return
+		self.received += len(data)
+		if self.limit is not None and self.received > self.limit:
+			self.set_exception(ApricotBodyTooLarge("Request body exceeds the size limit"))
+			return
+
+		self.buffer.append(data)
+		self.buffered += len(data)
+		self.wakeup()
+
+		if self.buffered > self.high_water and not self.paused:
+			if self.pause is not None:
+				self.paused = True
+				self.pause()
+
+	def feed_eof(self):
+		self.eof = True
+		self.wakeup()
+
+	def set_exception(self, exc):
+		self.exception = exc
+		self.buffer.clear()
+		self.buffered = 0
+		self.wakeup()
+
+	def wakeup(self):
+		if self.waiter is not None and not self.waiter.done():
+			self.waiter.set_result(None)
+		self.waiter = None
+
+	##### Handler side #####
+
+	async def readany(self):
+		''' read the next chunk, b'' once the body is finished '''
+		self.start()
+		while not self.buffer:
+			if self.exception is not None:
+				raise self.exception
+			if self.eof:
+				return b''
+			self.waiter = asyncio.get_event_loop().create_future()
+			await self.waiter
+
+		data = self.buffer.popleft()
+		self.buffered -= len(data)
+		if self.paused and self.buffered <= self.high_water // 4:
+			self.paused = False
+			self.resume()
+		return data
+
+	async def read(self):
+		''' read the whole body '''
+		chunks = []
+		while True:
+			data = await self.readany()
+			if not data: break
+			chunks.append(data)
+		return b''.join(chunks)
+
+	def __aiter__(self):
+		return self.iterate()
+
+	async def iterate(self):
+		while True:
+			data = await self.readany()
+			if not data: return
+			yield data
+
+
+class ApricotReaderBody(ApricotRequestBody):
+	''' Request body read on demand from an asyncio.StreamReader
+
+	Handles Content-Length and chunked transfer encoding, the StreamReader
+	buffer limit provides the backpressure.
+	'''
+
+	chunk_size = 64 * 1024
+
+	def __init__(self, reader, length=None, chunked=False, limit=None,
+		on_start=None, on_wait=None, on_data=None):
+		super().__init__(limit, on_start)
+		self.reader     = reader
+		self.on_wait    = on_wait # called with True/False around socket reads
+		self.on_data    = on_data # called with the size of every read
+		self.remaining  = length or 0
+		self.chunked    = chunked
+		self.chunk_left = 0
+
+	async def readany(self):
+		self.start()
+		if self.exception is not None:
+			raise self.exception
+		if self.eof:
+			return b''
+
+		if self.on_wait is not None:
+			self.on_wait(True)
+		try:
+			if self.chunked:
+				data = await self.read_chunked()
+			else:
+				data = await self.reader.read(min(self.remaining, self.chunk_size))
+				if not data:
+					raise asyncio.IncompleteReadError(b'', self.remaining)
+				self.remaining -= len(data)
+				if self.remaining == 0:
+					self.eof = True
+		except (asyncio.IncompleteReadError, ValueError) as exc:
+			self.exception = ConnectionResetError("Request body ended early")
+			raise self.exception from exc
+		finally:
+			if self.on_wait is not None:
+				self.on_wait(False)
+
+		self.received += len(data)
+		if self.on_data is not None:
+			self.on_data(len(data))
+		if self.limit is not None and self.received > self.limit:
+			self.exception = ApricotBodyTooLarge("Request body exceeds the size limit")
+			raise self.exception
+		return data
+
+	async def read_chunked(self):
+		''' read from the next chunk of a chunked body '''
+		if self.chunk_left == 0:
+			line = await self.reader.readline()
+			if not line.endswith(b'\n'):
+				raise asyncio.IncompleteReadError(line, None)
+			self.chunk_left = int(line.split(b';')[0].strip(), 16)
+
+			# last chunk, skip trailers
+			if self.chunk_left == 0:
+				while True:
+					line = await self.reader.readline()
+					if not line.endswith(b'\n'):
+						raise asyncio.IncompleteReadError(line, None)
+					if line in (b'\r\n', b'\n'):
+						break
+				self.eof = True
+				return b''
+
+		data = await self.reader.read(min(self.chunk_left, self.chunk_size))
+		if not data:
+			raise asyncio.IncompleteReadError(b'', self.chunk_left)
+		self.chunk_left -= len(data)
+		if self.chunk_left == 0:
+			await self.reader.readexactly(2)
+		return data
@@ -1,122 +1,431 @@
 #!/usr/bin/env python3
 #! python3
 
+import mmap
 import random
 import asyncio
+from time import perf_counter
+from functools import partial
 
-from ..utils import createResponse, BREAK
+from ..utils import createResponse, createResponseParts, createChunk
+from ..utils import getHeader, BREAK, CHUNK_END, CONTINUE
 from ._request import ApricotRequest
+from ._body import ApricotReaderBody, ApricotBodyTooLarge
+from ._response import ApricotResponse, ApricotStreamResponse
 
 class ApricotClient(object):
 	''' Apricot async server client '''
 
+	# bytes per write when a file can not be sent with sendfile
+	chunk_size = 256 * 1024
+
 	def __init__(self, reader, writer, server):
-		self.reader   = reader
-		self.writer   = writer
-		self.server   = server
-		self.running  = True
-		self.event    = asyncio.Event()
-		self.response = None
+		self.reader    = reader
+		self.writer    = writer
+		self.transport = writer.transport if writer is not None else None
+		self.server    = server
+		self.running   = True
+		self.response  = None
 
 		self.hasHeaders = False
 		self.headerData = b''
 		self.bodyData   = b''
 		self.badData    = [False, None, b'']
 
-	async def start(self):
-		''' event loop to process data '''
-		while self.running:
+		# keep-alive state
+		self.requests   = 0
+		self.handling   = False # a handler is running or its response is written
+		self.waiting    = False # waiting for the first line of the next request
 
-			# read http headers
-			data = await self.readline()
-			if data in self.badData:
-				self.running = False
-				break
+		# read deadline, kept by the server timer wheel
+		self.deadline     = None
+		self.timer_slot   = None
+		self.timeout_kind = None
 
-			while data not in self.badData:
+	async def start(self):
+		''' event loop to process data '''
+		try:
+			while self.running:
 
-				# exit on no data
-				if not data or self.reader.at_eof():
-					self.running = False
+				# wait for the next request on this connection
+				request = await self.read_request()
+				if request is None:
 					break
 
-				# break on http line break
-				if data == BREAK.encode('utf-8'):
-					self.hasHeaders = True
+				# route request and write the response
+				keep_alive = self.should_keep_alive(request)
+				try:
+					keep_alive = await self.handle_request(request, keep_alive)
+				except ConnectionError:
 					break
 
-				# append to header data if not break yet
-				if not self.hasHeaders:
-					self.headerData += data
-
-				# read data
-				data = await self.readline()
-				if data in self.badData:
-					self.running = False
+				# close the connection unless it is persistent
+				if not keep_alive:
 					break
+		except Exception as exc:
+			# a failure past the handler, the connection can not go on
+			asyncio.get_event_loop().call_exception_handler({
+				'message'  : 'Unhandled exception serving a connection',
+				'exception': exc
+			})
+		finally:
+			self.running = False
+			await self.close()
+
+	async def read_request(self):
+		''' read the next http request from the connection '''
+		self.hasHeaders = False
+		self.headerData = b''
+		self.bodyData   = b''
+
+		# a server shutting down takes no further requests
+		if self.requests and self.server.closing:
+			return None
 
-			# if not running, exit
-			if not self.running: break
-
-			# if headers are ready, its time to attempt to get body
-			# 1) process it through the router and generate response
-			# 2) send response to socket
-			# 3) if ok, get and save body
-			if self.hasHeaders:
-				
-				# build request object
-				request = ApricotRequest(self.headerData)
-				await request.build_async()
-
-				# get post data
-				if request.content_length is not None:
-					# get data
-					to_read = int(request.content_length)
-					data    = await self.read(to_read)
-
-					# decode by charset
-					if request.charset is not None:
-						if request.charset != '' and not request.charset.isspace():
-							charset = str(request.charset)
-						else: charset = 'utf-8'
-					else: charset = 'utf-8'
-
-					# set data
-					try:
-						request.body  = data
-						request.text  = data.decode(charset)
-						self.bodyData = data
-					except:
-						pass
-
-				# attempt to route
-				self.on_request(request)
-				await self.server.router.process_request(self, request)
-
-				# wait for coro to finish
-				await self.event.wait()
-
-				# set to 404 if a response object wasn't set
-				if self.response == None:
-					self.response = await self.server.router.default_404(request)
-
-				# create HTTP response
-				respContent = createResponse(self.response)
-				if not isinstance(respContent, bytes):
-					respContent = respContent.encode('utf-8')
-
-				# write http response and close connection
-				await self.write(respContent)
-				self.running = False
+		# idle connections close after keep_alive_timeout, a request head
+		# has header_timeout to arrive in full
+		self.arm('idle' if self.requests else 'header')
+		self.waiting = True
+		try:
+			data = await self.readline()
+		finally:
+			self.waiting = False
+		started = perf_counter()
+		if self.requests:
+			self.arm('header')
+		if data in self.badData:
+			return None
+
+		while data not in self.badData:
+
+			# exit on no data
+			if not data or self.reader.at_eof():
+				return None
+
+			# break on http line break
+			if data == BREAK.encode('utf-8'):
+				self.headerData += data
+				self.hasHeaders = True
 				break
 
-		# drain out thr write buffer
+			# append to header data if not break yet
+			if not self.hasHeaders:
+				self.headerData += data
+
+			# read data
+			data = await self.readline()
+			if data in self.badData:
+				return None
+
+		self.disarm()
+		if not self.hasHeaders:
+			return None
+
+		# build request object, malformed requests end the connection
+		received = perf_counter()
+		request  = ApricotRequest(self.headerData)
+		try:
+			await request.build_async()
+		except Exception:
+			await self.write(createResponse(ApricotResponse(status=400)))
+			return None
+		request.phases['header'] = received - started
+		request.phases['parse']  = perf_counter() - received
+		if self.server.metrics is not None:
+			self.server.metrics.bytes_in += len(self.headerData)
+
+		# the body is read on demand, by the handler or before routing
+		length, chunked = self.body_framing(request)
+		if length or chunked:
+			request.has_body = True
+			request.content  = ApricotReaderBody(self.reader, length, chunked,
+				self.server.max_body_size, partial(self.send_continue, request),
+				self.wait_body, self.count_body)
+
+		return request
+
+	def body_framing(self, request):
+		''' get (content length, chunked) of a request body '''
+		encoding = getHeader(request.headers, 'Transfer-Encoding')
+		if encoding is not None and 'chunked' in encoding.lower():
+			return None, True
+		return request.content_length, False
+
+	def body_too_large(self, request):
+		''' check a declared Content-Length against the body size limit '''
+		limit = self.server.max_body_size
+		if limit is None or request.content_length is None:
+			return False
+		return request.content_length > limit
+
+	def send_continue(self, request):
+		''' let a client waiting on Expect: 100-continue send its body '''
+		expect = getHeader(request.headers, 'Expect')
+		if expect is not None and expect.lower() == '100-continue':
+			if request.version != '1.0' and not self.transport.is_closing():
+				self.transport.write(CONTINUE)
+
+	async def read_body(self, request):
+		''' buffer the request body for handlers that do not stream it '''
+		data = await request.content.read()
+		self.on_read(data)
+		self.set_body(request, data)
+
+	async def reject(self, request, status, headers=None):
+		''' answer without reading the body, then close the connection '''
+		response = ApricotResponse(status=status, headers=headers)
+		await self.write(createResponse(response, False))
 		await self.drain()
+		self.record(request, status)
+		return False
+
+	def record(self, request, status):
+		''' add a finished request to the server metrics '''
+		if self.server.metrics is not None:
+			self.server.metrics.record(request, status)
+
+	def count_body(self, size):
+		if self.server.metrics is not None:
+			self.server.metrics.bytes_in += size
+
+	def set_body(self, request, data):
+		''' attach a request body, it is decoded when a handler asks for text '''
+		request.body     = data
+		request.has_body = True
+		self.bodyData    = data
+
+	##### Timeouts #####
+
+	def arm(self, kind):
+		''' start the read deadline of a phase, 'idle', 'header' or 'body' '''
+		timeout = self.server.timeouts[kind]
+		if timeout is None:
+			return self.disarm()
+		self.timeout_kind = kind
+		self.server.timers.schedule(self, self.server.loop.time() + timeout)
+
+	def disarm(self):
+		if self.timer_slot is not None:
+			self.server.timers.cancel(self)
+
+	def wait_body(self, waiting):
+		''' only time spent waiting on the client counts against body_timeout '''
+		if waiting:
+			self.arm('body')
+		else:
+			self.disarm()
+
+	def on_timeout(self):
+		''' a read ran past its deadline, close the connection to free its slot '''
+		self.server.timed_out[self.timeout_kind] += 1
+		if self.transport is None or self.transport.is_closing():
+			return
+		if self.timeout_kind != 'idle' and not self.handling:
+			self.transport.write(createResponse(ApricotResponse(status=408), False))
+		self.transport.close()
+
+	@property
+	def idle(self):
+		''' between requests, closing the connection loses nothing '''
+		return self.waiting and not self.handling
+
+	def should_keep_alive(self, request):
+		''' check if the connection persists after this request '''
+		self.requests += 1
+		if not self.server.keep_alive or not request.keep_alive:
+			return False
+		if self.server.max_requests is not None:
+			if self.requests >= self.server.max_requests:
+				return False
+		return True
+
+	async def handle_request(self, request, keep_alive=False):
+		''' admit a request, shedding it with a 503 when the server is busy '''
+		admission = self.server.admission
+		if not admission.enter():
+			return await self.reject(request, 503, admission.headers)
+		try:
+			return await self.serve_request(request, keep_alive)
+		finally:
+			self.handling = False
+			admission.leave()
+
+	async def serve_request(self, request, keep_alive=False):
+		''' route a request and write its response '''
+		self.response = None
+
+		# refuse a declared body over the limit before any of it is sent
+		if self.body_too_large(request):
+			return await self.reject(request, 413)
+
+		# routes that do not stream get the whole body up front
+		started = perf_counter()
+		self.server.router.route_request(request)
+		request.phases['route'] = perf_counter() - started
+		if request.content is not None:
+			if request.route is not None and not request.route.stream:
+				try:
+					await self.read_body(request)
+				except ApricotBodyTooLarge:
+					return await self.reject(request, 413)
+
+		# attempt to route
+		self.handling = True
+		self.on_request(request)
+
+		started = perf_counter()
+		self.response = await self.server.router.process_request(request)
+		request.phases['handler'] = perf_counter() - started
+
+		# set to 404 if a response object wasn't set
+		if self.response == None:
+			self.response = await self.server.router.default_404(request)
+
+		# async generators and iterables are streamed
+		if not isinstance(self.response, ApricotResponse):
+			if hasattr(self.response, '__aiter__'):
+				self.response = ApricotStreamResponse(body=self.response)
+
+		# cached responses come back from the innermost layer already encoded
+		if self.response.using == 'cached':
+			return await self.send_cached(request, self.response, keep_alive)
+
+		# opt-in compression
+		if self.server.compression is not None:
+			self.response = self.server.compression.apply(request, self.response)
+
+		# a body left unread keeps the connection from being reused
+		if request.content is not None and not request.content.eof:
+			keep_alive = False
+
+		keep_alive = await self.send_response(request, self.response, keep_alive)
+		self.record(request, self.response.status)
+		return keep_alive
+
+	async def send_cached(self, request, response, keep_alive=False):
+		''' write a cached response, or a 304 when the client has it already '''
+		started = perf_counter()
+		if request.content is not None and not request.content.eof:
+			keep_alive = False
+
+		# headers set by the middlewares apply to this response only
+		entry = response.entry
+		if entry.matches(request):
+			status, head, body = 304, entry.not_modified(keep_alive, response.headers), b''
+		else:
+			status, body = response.status, entry.body
+			head = entry.head(keep_alive, response.headers, status)
+		if body and request.method != 'HEAD':
+			await self.writelines((head, body))
+		else:
+			await self.write(head)
+		await self.drain()
+
+		request.phases['write'] = perf_counter() - started
+		self.record(request, status)
+		return keep_alive
+
+	async def send_response(self, request, response, keep_alive=False):
+		''' serialize and write a response '''
+		started = perf_counter()
+		if response.using == 'stream' and request.method != 'HEAD':
+			keep_alive = await self.send_stream(request, response, keep_alive)
+		elif response.using == 'file' and request.method != 'HEAD':
+			keep_alive = await self.send_file(request, response, keep_alive)
+		else:
+			# create HTTP response, header block and body go out unjoined
+			head, body = createResponseParts(response, keep_alive, request.method == 'HEAD')
+			serialized = perf_counter()
+			request.phases['serialize'] = serialized - started
+			started = serialized
+			if body:
+				await self.writelines((head, body))
+			else:
+				await self.write(head)
+			await self.drain()
+		request.phases['write'] = perf_counter() - started
+		return keep_alive
+
+	async def send_stream(self, request, response, keep_alive=False):
+		''' write a streamed response chunk by chunk, waiting on drain '''
+
+		# HTTP/1.0 has no chunked encoding, the body ends with the connection
+		chunked = request.version != '1.0'
+		if not chunked:
+			keep_alive = False
+			response.headers.pop('Transfer-Encoding', None)
+
+		await self.write(createResponse(response, keep_alive))
+		try:
+			async for chunk in response:
+				if chunked:
+					await self.writelines(createChunk(chunk))
+				else:
+					await self.write(chunk)
+				await self.drain()
+		except ConnectionError:
+			raise
+		except Exception as exc:
+			# headers are out, a truncated body is all the client can get
+			self.server.router.report(request, exc,
+				'Unhandled exception streaming the response for')
+			return False
+
+		if chunked:
+			await self.write(CHUNK_END)
+		await self.drain()
+		return keep_alive
+
+	async def send_file(self, request, response, keep_alive=False):
+		''' write a file response, its body goes through sendfile '''
+		f = response.file if response.file is not None else open(response.path, 'rb')
+		await self.write(createResponse(response, keep_alive))
+		with f:
+			for head, offset, count in response.parts:
+				if head:
+					await self.write(head)
+				await self.sendfile(f, offset, count)
+		if response.epilogue:
+			await self.write(response.epilogue)
+		await self.drain()
+		return keep_alive
+
+	async def sendfile(self, f, offset, count):
+		''' zero-copy send of part of a file, chunked mmap reads otherwise '''
+		if count <= 0:
+			return
+
+		try:
+			await self.drain()
+			loop = asyncio.get_event_loop()
+			await loop.sendfile(self.transport, f, offset, count, fallback=False)
+			if self.server.metrics is not None:
+				self.server.metrics.bytes_out += count
+			return
+		except (NotImplementedError, asyncio.SendfileNotAvailableError):
+			pass
+
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			end = offset + count
+			for pos in range(offset, end, self.chunk_size):
+				await self.write(mm[pos:min(pos + self.chunk_size, end)])
+				await self.drain()
+
+	async def close(self):
+		''' flush and close the connection '''
+		self.disarm()
+
+		# drain out thr write buffer
+		try:
+			await self.drain()
+		except ConnectionError:
+			pass
 
 		# EOF
 		self.on_eof()
-		if self.writer.can_write_eof():
-			self.writer.write_eof()
+		if not self.transport.is_closing() and self.writer.can_write_eof():
+			try: self.writer.write_eof()
+			except OSError: pass
 		self.reader.feed_eof()
 
 		# Exit
@@ -172,8 +481,18 @@ class ApricotClient(object):
 		if not isinstance(data, bytes):
 			data = data.encode('utf-8')
 		self.on_write(data)
+		if self.server.metrics is not None:
+			self.server.metrics.bytes_out += len(data)
 
 		self.writer.write(data)
 
+	async def writelines(self, data):
+		''' write a sequence of byte strings without joining them '''
+		for part in data:
+			self.on_write(part)
+		if self.server.metrics is not None:
+			self.server.metrics.bytes_out += sum(map(len, data))
+		self.writer.writelines(data)
+
 	async def drain(self):
-		await self.writer.drain()
\ No newline at end of file
+		await self.writer.drain()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+#! python3
+
+import asyncio
+from time import perf_counter
+from functools import partial
+from collections import deque
+
+from ..utils import createResponse
+from ._client import ApricotClient
+from ._parser import ApricotParser
+from ._request import ApricotRequest
+from ._body import ApricotRequestBody
+from ._response import ApricotResponse
+
+class ApricotConnection(ApricotClient, asyncio.Protocol):
+	''' Apricot server client driven by asyncio.Protocol callbacks
+
+	Bytes from data_received go straight into one long lived httptools
+	parser, requests are built from its callbacks and served in order by
+	the ApricotClient request loop.
+	'''
+
+	# pipelined requests buffered before reading is paused
+	max_pending = 16
+
+	def __init__(self, server):
+		ApricotClient.__init__(self, None, None, server)
+		self.transport = None
+		self.task      = None
+		self.parser    = ApricotParser('request',
+			self.on_message, self.on_headers, self.on_chunk, self.on_begin)
+
+		# parsed requests waiting to be served
+		self.pending   = deque()
+		self.ready     = asyncio.Event()
+		self.current   = None  # request whose body is being received
+		self.holds     = set() # reasons reading is paused for
+		self.receiving = None  # 'header' or 'body' while a request arrives
+		self.started   = 0.0   # perf_counter when the current head began
+
+		# write flow control
+		self.can_write = asyncio.Event()
+		self.can_write.set()
+
+	##### asyncio.Protocol callbacks #####
+
+	def connection_made(self, transport):
+		''' start serving requests for a new connection '''
+		self.transport = transport
+
+		# shed connections over the limit
+		if not self.server.admission.admit_connection(self.server.clients):
+			self.running = False
+			transport.write(self.server.admission.rejection())
+			if transport.can_write_eof():
+				transport.write_eof()
+			asyncio.get_event_loop().call_later(
+				self.server.admission.linger, transport.close)
+			return
+
+		self.task      = asyncio.ensure_future(self.start())
+
+		# add client to server clients
+		self.server.clients[self.task] = (self, None, transport)
+		self.task.add_done_callback(self.server.on_client_exit)
+
+	def data_received(self, data):
+		''' feed bytes straight to the request parser '''
+		if self.task is None:
+			return # rejected, waiting for the client to close
+		self.on_read(data)
+		if self.server.metrics is not None:
+			self.server.metrics.bytes_in += len(data)
+		try:
+			self.parser.feed_data(data)
+		except Exception:
+			self.transport.write(createResponse(ApricotResponse(status=400)))
+			self.transport.close()
+			self.end_of_stream()
+
+	def eof_received(self):
+		if self.task is None:
+			return
+		self.end_of_stream()
+
+	def connection_lost(self, exc):
+		self.can_write.set()
+		if self.current is not None and self.current.content is not None:
+			self.current.content.set_exception(ConnectionResetError("Connection lost"))
+		self.end_of_stream()
+
+	def pause_writing(self):
+		self.can_write.clear()
+
+	def resume_writing(self):
+		self.can_write.set()
+
+	##### Parser callbacks #####
+
+	def on_begin(self):
+		''' the first bytes of a request arrived '''
+		self.receiving = 'header'
+		self.started   = perf_counter()
+		if not self.holds:
+			self.arm('header')
+
+	def on_headers(self):
+		''' queue a request as soon as its head is parsed '''
+		received = perf_counter()
+		request  = ApricotRequest.from_parser(self.parser)
+		request.phases['header'] = received - self.started
+		request.phases['parse']  = perf_counter() - received
+
+		# the body follows through on_chunk
+		length, chunked = self.body_framing(request)
+		if length or chunked:
+			request.has_body = True
+			request.content  = ApricotRequestBody(self.server.max_body_size,
+				partial(self.send_continue, request),
+				partial(self.hold_reading, 'body'),
+				partial(self.release_reading, 'body'))
+
+		self.current   = request
+		self.receiving = 'body' if request.content is not None else None
+		if self.receiving is not None:
+			self.arm('body')
+		else:
+			self.disarm()
+
+		self.pending.append(request)
+		self.ready.set()
+
+		# stop reading when a client pipelines too far ahead
+		if len(self.pending) >= self.max_pending:
+			self.hold_reading('pipeline')
+
+	def on_chunk(self, data):
+		''' pass body bytes to the request being received '''
+		if self.current is not None and self.current.content is not None:
+			self.arm('body')
+			self.current.content.feed_data(data)
+
+	def on_message(self):
+		''' the current request body is complete '''
+		if self.current is not None and self.current.content is not None:
+			self.current.content.feed_eof()
+		self.current   = None
+		self.receiving = None
+		self.disarm()
+
+	def hold_reading(self, reason):
+		''' pause the transport until every hold is released '''
+		if not self.holds and not self.transport.is_closing():
+			self.transport.pause_reading()
+			self.disarm() # the client is not the one holding things up
+		self.holds.add(reason)
+
+	def release_reading(self, reason):
+		if reason in self.holds:
+			self.holds.discard(reason)
+			if not self.holds and not self.transport.is_closing():
+				self.transport.resume_reading()
+				if self.receiving is not None:
+					self.arm(self.receiving)
+
+	def end_of_stream(self):
+		''' wake the request loop with no more requests to come '''
+		self.pending.append(None)
+		self.ready.set()
+
+	##### ApricotClient overrides #####
+
+	@property
+	def idle(self):
+		''' between requests, closing the connection loses nothing '''
+		return not self.handling and not self.pending and self.receiving is None
+
+	async def read_request(self):
+		''' wait for the next parsed request '''
+		if self.requests and self.server.closing and self.idle:
+			return None
+		if not self.pending and self.receiving is None:
+			self.arm('idle' if self.requests else 'header')
+		while not self.pending:
+			self.ready.clear()
+			await self.ready.wait()
+
+		request = self.pending.popleft()
+		if len(self.pending) < self.max_pending:
+			self.release_reading('pipeline')
+		return request
+
+	async def read_body(self, request):
+		''' buffer the request body for handlers that do not stream it '''
+		self.set_body(request, await request.content.read())
+
+	async def write(self, data, eof=False):
+		''' write data to client '''
+		if eof: data += "\n"
+		if not isinstance(data, bytes):
+			data = data.encode('utf-8')
+		self.on_write(data)
+		if self.server.metrics is not None:
+			self.server.metrics.bytes_out += len(data)
+
+		self.transport.write(data)
+
+	async def writelines(self, data):
+		''' write a sequence of byte strings without joining them '''
+		for part in data:
+			self.on_write(part)
+		if self.server.metrics is not None:
+			self.server.metrics.bytes_out += sum(map(len, data))
+		self.transport.writelines(data)
+
+	async def drain(self):
+		if self.transport.is_closing():
+			raise ConnectionResetError('Connection lost')
+		await self.can_write.wait()
+
+	async def close(self):
+		''' flush and close the connection '''
+		self.disarm()
+		self.on_eof()
+		if not self.transport.is_closing():
+			if self.transport.can_write_eof():
+				try: self.transport.write_eof()
+				except OSError: pass
+		self.on_exit()
+		self.transport.close()
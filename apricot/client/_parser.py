@@ -4,30 +4,59 @@
 from httptools import parse_url
 from httptools import HttpRequestParser
 from httptools import HttpResponseParser
+from ..utils import ApricotHeaders
 
 class AbstractParser(object):
 	''' httptools python struct parsing '''
 
-	def __init__(self):
-		self.headers     = {}
+	def __init__(self, on_message=None, on_headers=None, on_chunk=None, on_begin=None):
+		self.headers     = ApricotHeaders()
 		self.body        = b''
+		self.url         = b''
+		self.reason      = b''
+		self.chunks      = []
+		self.complete    = False
+		self.on_message  = on_message
+		self.on_headers  = on_headers
+		self.on_chunk    = on_chunk
+		self.on_begin    = on_begin
 
-	def on_header(self, name, _value):
-		key, value = name.decode(), _value.decode()
-		dup = [x for x in self.headers if x.startswith(key)]
-		if len(dup) > 0:
-			key += str(len(dup))
-		self.headers[key] = value
+	def on_header(self, name, value):
+		self.headers.add(name, value)
+
+	def on_url(self, url):
+		self.url += url
+
+	def on_status(self, status):
+		self.reason += status
 
 	def on_body(self, data):
-		self.body += data
+		if self.on_chunk is not None:
+			self.on_chunk(bytes(data))
+		else:
+			self.chunks.append(bytes(data))
 
 	def on_message_complete(self):
+		self.body = b''.join(self.chunks)
 		if self.body == b'': self.body = None
-
-	def on_message_begin(self): pass
-
-	def on_headers_complete(self): pass
+		self.complete = True
+		if self.on_message is not None:
+			self.on_message()
+
+	def on_message_begin(self):
+		# fresh containers per message, earlier requests keep theirs
+		self.headers  = ApricotHeaders()
+		self.body     = b''
+		self.url      = b''
+		self.reason   = b''
+		self.chunks   = []
+		self.complete = False
+		if self.on_begin is not None:
+			self.on_begin()
+
+	def on_headers_complete(self):
+		if self.on_headers is not None:
+			self.on_headers()
 
 	def on_chunk_header(self): pass
 
@@ -37,9 +66,10 @@ class AbstractParser(object):
 class ApricotParser(object):
 	''' Apricot Http Parser '''
 
-	def __init__(self, parseType="request"):
+	def __init__(self, parseType="request", on_message=None, on_headers=None,
+		on_chunk=None, on_begin=None):
 		# create abstract parser
-		self.parser = AbstractParser()
+		self.parser = AbstractParser(on_message, on_headers, on_chunk, on_begin)
 
 		# determine httptools parser
 		if parseType.lower() == "request":
@@ -47,13 +77,9 @@ class ApricotParser(object):
 		else:
 			self.parsed = HttpResponseParser(self.parser)
 
-		# set null url info
-		self.url     = None
-		self.host    = None
-		self.schema  = None
-		self.port    = None
-		self.path    = None
-		self.params  = {} 
+		# url info is parsed on first access
+		self.path     = None
+		self.url_info = None
 
 	async def feed_async(self, data=b''):
 		self.feed(data)
@@ -64,6 +90,10 @@ class ApricotParser(object):
 		self.parsed.feed_data(memoryview(data))
 		self.set_attributes() # set apricot attributes
 
+	def feed_data(self, data):
+		''' feed a chunk of a stream, on_message fires per complete message '''
+		self.parsed.feed_data(data)
+
 	def set_attributes(self):
 		''' set ApricotParser attributes '''
 
@@ -72,11 +102,15 @@ class ApricotParser(object):
 			self.method = self.parsed.get_method().decode()
 		else:
 			self.status = self.parsed.get_status_code()
+			self.reason = self.parser.reason.decode('latin-1')
 
 		# set basic attr's
+		self.url_info = None
 		try:
 			self.headers    = self.parser.headers
 			self.body       = self.parser.body
+			if not self.parser.complete and self.parser.chunks:
+				self.body = b''.join(self.parser.chunks)
 			self.http_ver   = self.parsed.get_http_version()
 			self.keep_alive = self.parsed.should_keep_alive()
 		except Exception as e:
@@ -84,28 +118,52 @@ class ApricotParser(object):
 
 		if self.keep_alive == None: self.keep_alive = False
 
-		# parse url and get info
-		self.get_url_info()
+		# an explicit Connection header decides persistence
+		value = self.headers.get('Connection')
+		if value is not None:
+			value = value.lower()
+			if 'close' in value: self.keep_alive = False
+			elif 'keep-alive' in value: self.keep_alive = True
+
+		if isinstance(self.parsed, HttpRequestParser):
+			self.path = self.parser.url
+
+	@property
+	def url(self): return self.get_url_info()['url']
+
+	@property
+	def host(self): return self.get_url_info()['host']
+
+	@property
+	def schema(self): return self.get_url_info()['schema']
+
+	@property
+	def port(self): return self.get_url_info()['port']
+
+	@property
+	def params(self): return self.get_url_info()['params']
 
 	def get_url_info(self):
-		''' Parse url info '''
+		''' Parse url info, once per message '''
+		if self.url_info is not None:
+			return self.url_info
+		info = self.url_info = {'url': None, 'host': None, 'schema': None,
+			'port': None, 'params': {}}
 		if 'Host' in self.headers:
 			try:
 				# make url
-				self.url = b'http://'
-				self.url += self.headers['Host'].encode()
+				url = b'http://'
+				url += self.headers['Host'].encode()
 
 				# add path if request
-				if isinstance(self.parsed, HttpRequestParser):
-					path = self.raw_data.split(b'\r\n')[0].split()[1]
-					self.url += path
-					self.path = path
+				if self.path is not None:
+					url += self.path
 
 				# parse url and get basic info
-				URL = parse_url(self.url)
-				self.schema = URL.schema.decode()
-				self.host   = URL.host.decode()
-				self.port   = URL.port
+				URL = parse_url(url)
+				info['schema'] = URL.schema.decode()
+				info['host']   = URL.host.decode()
+				info['port']   = URL.port
 
 				# get url query parameters if any
 				if URL.query is not None:
@@ -113,11 +171,12 @@ class ApricotParser(object):
 						parts = param.split(b'=')
 						key   = parts[0].decode()
 						value = b'='.join(parts[1:]).decode()
-						self.params[key] = value
+						info['params'][key] = value
 
 				# decode url from bytes to string
-				self.url = self.url.decode()
+				info['url'] = url.decode()
 			except:
 				pass
+		return info
 
 
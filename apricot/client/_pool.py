@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#! python3
+
+import asyncio
+from collections import deque
+
+class ApricotPoolClosed(Exception): pass
+
+class ApricotConnectionPool(object):
+	''' Keep-alive connections of an ApricotSession by (schema, host, port)
+
+	acquire() hands out an idle connection of the host when a healthy one
+	is left, or opens a new one while under limit and limit_per_host. Past
+	the limits callers wait in one first come first served queue and are
+	handed connections as they are released or closed. Connections idle for more
+	than idle_timeout seconds are closed.
+	'''
+
+	def __init__(self, loop=None, limit=100, limit_per_host=None, idle_timeout=30.0):
+		self.loop           = loop if loop is not None else asyncio.get_event_loop()
+		self.limit          = limit
+		self.limit_per_host = limit_per_host
+		self.idle_timeout   = idle_timeout
+		self.idle           = {}      # key -> deque of (protocol, released at)
+		self.opened         = {}      # key -> open or opening connections
+		self.total          = 0
+		self.waiters        = deque() # (key, future) in arrival order
+		self.handle         = None    # idle sweep timer
+		self.closed         = False
+
+		# reuse statistics
+		self.created = 0
+		self.reused  = 0
+
+	##### Checkout #####
+
+	async def acquire(self, key, connect):
+		''' a connection for key, connect() opens a new one '''
+		if self.closed:
+			raise ApricotPoolClosed("Connection pool is closed")
+
+		protocol = self.checkout(key)
+		if protocol is not None:
+			self.reused += 1
+			return protocol
+
+		# open a new one, unless earlier callers are still waiting
+		if not self.waiters and self.reserve(key):
+			return await self.open(key, connect)
+
+		# wake() hands over an idle connection or reserves a slot
+		waiter = self.loop.create_future()
+		self.waiters.append((key, waiter))
+		self.wake()
+		try:
+			protocol = await waiter
+		except asyncio.CancelledError:
+			if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+				if waiter.result() is not None:
+					self.release(key, waiter.result())
+				else:
+					self.forget(key)
+					self.wake()
+			raise
+		finally:
+			try:
+				self.waiters.remove((key, waiter))
+			except ValueError:
+				pass
+
+		if protocol is not None:
+			self.reused += 1
+			return protocol
+		return await self.open(key, connect)
+
+	def checkout(self, key):
+		''' most recently released healthy idle connection of key '''
+		idle = self.idle.get(key)
+		now  = self.loop.time()
+		while idle:
+			protocol, released = idle.pop()
+			fresh = self.idle_timeout is None or now - released < self.idle_timeout
+			if fresh and protocol.healthy:
+				return protocol
+			self.discard(key, protocol)
+		return None
+
+	def reserve(self, key):
+		''' take a slot for a new connection to key if the limits allow it,
+		closing an idle connection of another host when at the total limit
+		'''
+		if self.limit_per_host is not None and self.opened.get(key, 0) >= self.limit_per_host:
+			return False
+		if self.limit is not None and self.total >= self.limit and not self.evict():
+			return False
+		self.opened[key] = self.opened.get(key, 0) + 1
+		self.total += 1
+		return True
+
+	def evict(self):
+		''' close the longest idle connection of any host '''
+		oldest = None
+		for key, idle in self.idle.items():
+			if idle and (oldest is None or idle[0][1] < self.idle[oldest][0][1]):
+				oldest = key
+		if oldest is None:
+			return False
+		protocol, _ = self.idle[oldest].popleft()
+		self.discard(oldest, protocol)
+		return True
+
+	async def open(self, key, connect):
+		''' connect in a reserved slot '''
+		try:
+			protocol = await connect()
+		except BaseException:
+			self.forget(key)
+			self.wake()
+			raise
+		self.created += 1
+		return protocol
+
+	##### Checkin #####
+
+	def release(self, key, protocol, reuse=True):
+		''' give a connection back, it is kept when reuse and it can take another request '''
+		if reuse and not self.closed and protocol.reusable and protocol.healthy:
+			self.idle.setdefault(key, deque()).append((protocol, self.loop.time()))
+			self.schedule_sweep()
+		else:
+			self.discard(key, protocol)
+		self.wake()
+
+	def discard(self, key, protocol):
+		''' close a connection and free its slot '''
+		if protocol.transport is not None:
+			protocol.transport.close()
+		self.forget(key)
+
+	def forget(self, key):
+		count = self.opened.get(key, 0) - 1
+		if count > 0:
+			self.opened[key] = count
+		else:
+			self.opened.pop(key, None)
+			self.idle.pop(key, None)
+		self.total -= 1
+
+	def wake(self):
+		''' hand idle connections and free slots to waiters, first come first served '''
+		for key, waiter in self.waiters:
+			if waiter.done():
+				continue
+			protocol = self.checkout(key)
+			if protocol is not None:
+				waiter.set_result(protocol)
+			elif self.reserve(key):
+				waiter.set_result(None)
+
+	##### Idle expiry #####
+
+	def schedule_sweep(self):
+		''' run sweep() when the longest idle connection expires '''
+		if self.handle is not None or self.idle_timeout is None:
+			return
+		oldest = [idle[0][1] for idle in self.idle.values() if idle]
+		if oldest:
+			self.handle = self.loop.call_at(min(oldest) + self.idle_timeout, self.sweep)
+
+	def sweep(self):
+		''' close connections idle for longer than idle_timeout '''
+		self.handle = None
+		deadline = self.loop.time() - self.idle_timeout
+		for key in list(self.idle):
+			idle = self.idle.get(key)
+			while idle and idle[0][1] <= deadline:
+				protocol, _ = idle.popleft()
+				self.discard(key, protocol)
+		self.schedule_sweep()
+		self.wake()
+
+	def close(self):
+		''' close idle connections, connections in use close when released '''
+		self.closed = True
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+		for key in list(self.idle):
+			idle = self.idle.get(key)
+			while idle:
+				protocol, _ = idle.popleft()
+				self.discard(key, protocol)
+		for _, waiter in self.waiters:
+			if not waiter.done():
+				waiter.set_exception(ApricotPoolClosed("Connection pool is closed"))
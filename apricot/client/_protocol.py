@@ -2,10 +2,24 @@
 #! python3
 
 import asyncio
-from ..utils import generateID, _BREAK, END_BREAK, CHUNKED, CHUNK_END, _CLEN
+from httptools import HttpParserError
+from ..utils import generateID
+from ._parser import ApricotParser
+from ._body import ApricotRequestBody
+
+class ApricotResponseError(ConnectionError): pass
 
 class ApricotProtocol(asyncio.Protocol):
-	''' UvLoop async TCP Protocol Server '''
+	''' UvLoop async TCP Protocol Server
+
+	Bytes are fed to one httptools response parser as they arrive, the body
+	pieces are collected in a list and joined once. The response is ready
+	when the parser completes the message, for HEAD requests once the headers
+	are in, and for bodies without a length when the server closes.
+
+	Streamed responses are ready once the headers are in, their body pieces
+	are queued in content and reading pauses while the reader lags behind.
+	'''
 
 	def __init__(self, loop, session=None, httpData=b'', _id=None):
 		# get loop and session
@@ -14,131 +28,199 @@ class ApricotProtocol(asyncio.Protocol):
 		if self.hasSession: self.session = session
 		self.uuid = generateID() if _id == None else _id
 
-		# create read info
-		self.httpData    = httpData
-		self.data        = b''
-		self.bodyData    = b''
-		self.headerData  = b''
-		self.headerEnd   = False
-		self.onlyHeader  = False
-		self.length      = None
-		self.chunk_len   = 0
-
 		# events for on_finish
-		self.isReady    = asyncio.Event()
 		self.isClosed   = asyncio.Event()
 
+		# keep-alive state
+		self.transport  = None
+		self.requests   = 0     # requests sent on this connection
+		self.eof        = False
+
+		# create read info
+		self.reset(httpData)
+
 		# register Protocol to client
 		if self.hasSession:
 			self.session.connections[self.uuid] = self
-			self.session.conn_ready[self.uuid].set()
 
+	def reset(self, httpData, stream=False, on_done=None):
+		''' clear the read state for the next request on the connection '''
+		self.httpData   = httpData
+		self.head       = httpData[:5] == b'HEAD '
+		self.stream     = stream and not self.head
+		self.parser     = ApricotParser('response', on_message=self.on_message,
+			on_headers=self.on_headers, on_begin=self.on_begin,
+			on_chunk=self.on_chunk if self.stream else None)
+		self.headerEnd  = False
+		self.complete   = False
+		self.response   = None  # the ApricotParser, finished unless streamed
+		self.content    = None  # ApricotRequestBody of a streamed body
+		self.on_done    = on_done # called when a streamed response ends
+		self.error      = None
+		self.stray      = False # bytes after the response
+		self.reusable   = False # can take another request once ready
+		self.isReady    = asyncio.Event()
+
+	async def request(self, httpData, stream=False, on_done=None):
+		''' write a request and wait for its parsed response, None when
+		the connection closed before one arrived
+		@param stream : return once the headers are in, the body follows in content
+		@param on_done : called once a streamed response ended or failed
+		'''
+		self.reset(httpData, stream, on_done)
+		self.requests += 1
+
+		# closed while it was handed over, the session retries elsewhere
+		if not self.healthy:
+			self.reusable = False
+			return None
+
+		self.transport.write(httpData)
+		await self.isReady.wait()
+		if self.error is not None:
+			raise self.error
+		return self.response
+
+	@property
+	def healthy(self):
+		''' check an idle connection is still open and quiet '''
+		return self.transport is not None and not self.transport.is_closing() \
+			and not self.eof and not self.isClosed.is_set()
+
+	##### Parser callbacks #####
+
+	def on_begin(self):
+		if self.complete:
+			self.stray = True
+
+	def on_headers(self):
+		self.headerEnd = True
+		status = self.parser.parsed.get_status_code()
+
+		# a HEAD response has no body whatever its Content-Length says
+		if self.head:
+			self.finish(self.parser.parsed.should_keep_alive())
+
+		# a streamed response is handed out before its body
+		elif self.stream and not 100 <= status < 200:
+			self.content = ApricotRequestBody(pause=self.pause_reading,
+				resume=self.resume_reading)
+			self.parser.set_attributes()
+			self.response = self.parser
+			self.isReady.set()
+
+	def on_chunk(self, data):
+		self.content.feed_data(data)
+
+	def on_message(self):
+		# interim 1xx responses come before the final one
+		status = self.parser.parsed.get_status_code()
+		if 100 <= status < 200 and status != 101:
+			self.headerEnd = False
+			return
+		if not self.complete:
+			self.finish(self.parser.parsed.should_keep_alive() and status != 101)
+
+	def finish(self, keep_alive):
+		''' the response is complete, keep the connection or close it '''
+		parser = self.parser
+		if self.head:
+			parser.parser.body   = None
+			parser.parser.chunks = []
+		parser.set_attributes()
+		self.complete = True
+		self.response = parser
+		self.reusable = self.hasSession and keep_alive and parser.keep_alive and not self.eof
+		if not self.reusable and self.transport is not None:
+			self.transport.close()
+		if self.content is not None:
+			self.content.feed_eof()
+		self.isReady.set()
+		self.done()
+
+	def done(self):
+		''' tell the owner of a streamed response it ended '''
+		on_done, self.on_done = self.on_done, None
+		if on_done is not None and self.content is not None:
+			on_done()
+
+	def closed(self):
+		''' the server closed, a body without a length ends here '''
+		if self.complete:
+			return
+		if self.headerEnd:
+			headers = self.parser.parser.headers
+			if 'Content-Length' in headers or 'Transfer-Encoding' in headers:
+				self.fail(ApricotResponseError("Connection closed before the response ended"))
+			else:
+				self.finish(False)
+			return
+		self.complete = True
+		self.isReady.set()
+
+	def fail(self, error):
+		''' the response can not be completed '''
+		self.complete = True
+		self.reusable = False
+		if self.content is not None:
+			self.content.set_exception(error)
+		else:
+			self.error = error
+		self.isReady.set()
+		self.done()
+
+	def pause_reading(self):
+		if self.transport is not None and not self.transport.is_closing():
+			self.transport.pause_reading()
+
+	def resume_reading(self):
+		if self.transport is not None and not self.transport.is_closing():
+			self.transport.resume_reading()
+
+	##### Transport callbacks #####
 
 	def connection_made(self, transport):
 		""" On connection made """
-		
+
 		# get client info
 		self.transport   = transport
 		self.socket      = self.transport.get_extra_info('socket')
 		self.server_addr = self.transport.get_extra_info('peername')
 
 		# write http data
-		self.transport.write(self.httpData)
+		if self.httpData:
+			self.transport.write(self.httpData)
 
 	def data_received(self, data):
 		""" Receive and process data """
-		chunked = False
-
-		# get the headers
-		if not self.headerEnd:
-			# set header data
-			self.data += data
-			self.headerData = data
-			self.headerEnd  = True
-
-			# get content length
-			if _CLEN in self.headerData:
-				for header in self.headerData.split(_BREAK):
-					try:
-						key   = header.split(b': ')[0]
-						value = b': '.join(header.split(b': ')[1:])
-						if str(key).lower() == str(_CLEN).lower():
-							self.length = int(value)
-					except:
-						pass
-			if self.length is not None: chunked = True
-
-			# break on header end
-			if CHUNKED not in self.headerData:
-				if self.length == None or self.length == 0:
-					if self.headerData.endswith(_BREAK):
-						chunked = False
-						self.isReady.set()
-
-			# if header only, break
-			if self.httpData.startswith(b'HEAD'):
-				chunked = False
-				self.isReady.set()
-
-			# if redirect, break
-			resp_code = int(self.headerData.split(_BREAK)[0].split()[1])
-			if str(resp_code)[0] == '3':
-				chunked = False
-				self.isReady.set()
-
-			# if data already provided, break
-			if self.length is not None and self.length > 0:
-				self.bodyData = END_BREAK.join(self.headerData.split(END_BREAK)[1:])
-				if len(self.bodyData) == self.length:
-					chunked = False
-					self.isReady.set()
-
-		# chunking data after transfer encoding
-		else:
-			if CHUNKED in self.data:
-				# chunk data
-				self.data += data
-				self.bodyData += data
-				self.chunk_len += len(data)
-				chunked = True
-
-				# exit on End Of Chunk Header
-				if data.endswith(CHUNK_END):
-					self.isReady.set()
-			else:
-				# still chunk data if content length was reached
-				if self.length is not None and self.chunk_len < self.length:
-					# chunk data
-					if data != self.headerData:
-						self.bodyData += data
-						self.data += data
-						self.chunk_len += len(data)
-						chunked = True
-				else:
-					# Exit if not chunked stream
-					self.isReady.set()
-
-		# break if content length was reached
-		if chunked:
-			if self.length is not None:
-				if self.chunk_len >= self.length:
-					self.isReady.set()
-
-		# if not chunkable, exit
-		if CHUNKED not in self.data and not chunked:
-			self.isReady.set()
-		else:
-			if CHUNKED in self.data and self.data.endswith(CHUNK_END):
-				self.isReady.set()
 
-		# If ready to exit, close connection
-		if self.isReady.is_set():
+		# bytes after a complete response, the connection is out of step
+		if self.complete:
+			self.reusable = False
+			self.transport.close()
+			return
+
+		try:
+			self.parser.feed_data(data)
+		except HttpParserError as err:
+			if not self.complete:
+				self.fail(ApricotResponseError("Malformed response: %s" % err))
+			self.stray = True
+
+		# a HEAD response followed by a body or a second response
+		if self.stray or (self.head and self.parser.parser.chunks):
+			self.reusable = False
 			self.transport.close()
 
 	def connection_lost(self, exc):
 		self.isClosed.set()
+		self.closed()
+		if self.hasSession:
+			self.session.connections.pop(self.uuid, None)
 
 	def eof_received(self):
-		self.isReady.set()
+		self.eof      = True
+		self.reusable = False
+		self.closed()
 		try: self.transport.close()
-		except: pass
\ No newline at end of file
+		except: pass
@@ -1,27 +1,57 @@
 #!/usr/bin/env python3
 #! python3
 
-from ..utils import json
+from httptools import parse_url
+from ..utils import json, ApricotHeaders
 from ._parser import ApricotParser
 
+# marks a lazy attribute that was not worked out yet
+UNSET = object()
+
 class ApricotRequest(object):
-	''' Apricot HTTP Request Object '''
+	''' Apricot HTTP Request Object
+
+	Values derived from the headers, the query, the cookies and the decoded
+	body are worked out on first access and kept, handlers rarely touch more
+	than a few of them.
+	'''
+
+	__slots__ = ('data', 'parser', 'body', 'headers', 'scheme', 'method', 'version',
+		'path', 'match_info', 'keep_alive', 'has_body', 'content', 'route', 'handler',
+		'timings', 'inner_time', 'phases', '_state', '_host', '_query', '_cookies',
+		'_content_type', '_charset', '_content_length', '_text', '_json')
 
 	def __init__(self, data=b''):
 		self.data           = data
+		self.parser         = None
 		self.body           = None
-		self.headers        = {}
+		self.headers        = ApricotHeaders()
 		self.scheme         = 'http'
 		self.method         = "GET"
 		self.version        = '1.1'
-		self.host           = None
-		self.query_dict     = {}
+		self.path           = None
+		self.match_info     = {}
 		self.keep_alive     = False
-		self.cookies        = {}
 		self.has_body       = False
-		self.content_type   = ''
-		self.charset        = None
-		self.content_length = None
+		self.content        = None # ApricotRequestBody when a body follows
+		self.route          = None
+		self.handler        = None
+		self.timings        = {} # layer name -> seconds spent in it
+		self.inner_time     = 0.0
+		self.phases         = {} # server phase -> seconds, see ApricotMetrics
+		self._state         = None
+		self.clear_cached()
+
+	def clear_cached(self):
+		''' forget lazily worked out values '''
+		self._host           = UNSET
+		self._query          = UNSET
+		self._cookies        = UNSET
+		self._content_type   = UNSET
+		self._charset        = UNSET
+		self._content_length = UNSET
+		self._text           = UNSET
+		self._json           = UNSET
 
 	def build(self):
 		self.parser = ApricotParser('request')
@@ -33,94 +63,135 @@ class ApricotRequest(object):
 		await self.parser.feed_async(self.data)
 		self.set_attributes()
 
-	async def read():
-		if self.parser.body not in [b'', None]:
-			if not self.parser.body.isspace():
-				return self.body
-		return None
-
-	async def text():
-		if self.parser.body != None:
-			data = self.parser.body.decode()
-			if self.charset is not None:
-				charset = self.charset.lower()
-			else:
-				charset = 'utf-8'
-			data = data.encode(charset)
-			return data.decode(charset)
-		return ''
+	@classmethod
+	def from_parser(cls, parser):
+		''' build a request from a parser that already consumed the message '''
+		request = cls()
+		request.parser = parser
+		parser.set_attributes()
+		request.set_attributes()
+		return request
+
+	async def read(self):
+		''' read the whole body '''
+		if self.body is None and self.content is not None:
+			self.body = await self.content.read()
+		return self.body
+
+	def stream(self):
+		''' iterate over the body as it arrives, for routes added with stream=True '''
+		if self.body is None and self.content is not None:
+			return self.content.iterate()
+		return self.iterate_body()
+
+	async def iterate_body(self):
+		if self.body:
+			yield self.body
+
+	async def text(self):
+		if self._text is UNSET:
+			body = await self.read()
+			if body is None:
+				return ''
+			self._text = body.decode(self.charset or 'utf-8')
+		return self._text
 
 	async def json(self, loads=json.loads):
-		body = await self.text()
-		if body is not None:
-			return loads(body)
-		return None
-
+		if loads is not json.loads:
+			return loads(await self.text())
+		if self._json is UNSET:
+			self._json = loads(await self.text())
+		return self._json
 
 	def set_attributes(self):
-		self.body    = self.parser.body
-		self.headers = self.parser.headers
-		self.version = self.parser.http_ver
-
-		# get method
-		try:
-			self.method = self.parser.method
-			if isinstance(self.method, bytes):
-				self.method = self.method.decode('utf-8')
-			self.method = self.method.upper()
-		except: pass
-
-		# get host
-		try: self.host = self.parser.host
-		except: pass
-
-		# get query dict
-		try:
-			self.path       = self.parser.path
-			self.query_dict = self.parser.params
-		except:
-			pass
-
-		# get has body
-		if self.body is not None: self.has_body = True
-
-		# get connection keep alive
-		self.keep_alive = self.parser.keep_alive
-
-		# set variables by header values
-		for head in self.headers:
-
-			# get cookies
-			if 'set-cookie' in head.lower():
-				value = self.headers[head]
+		parser = self.parser
+		self.body       = parser.body or None
+		self.has_body   = self.body is not None
+		self.headers    = parser.headers
+		self.version    = parser.http_ver
+		self.keep_alive = parser.keep_alive
+		self.path       = parser.path
+		self.method     = parser.method.upper()
+		self.clear_cached()
+
+	##### Lazy attributes #####
+
+	@property
+	def state(self):
+		''' dict for middlewares and handlers to share values of the request,
+		requests have __slots__ so new attributes can not be set
+		'''
+		if self._state is None:
+			self._state = {}
+		return self._state
+
+	@property
+	def host(self):
+		''' host name of the Host header '''
+		if self._host is UNSET:
+			self._host = None
+			value = self.headers.get('Host')
+			if value:
 				try:
-					info  = {}
-					parts = value.split(';')
-					for part in parts:
-						cookieVal = '='.join(part.split('=')[1:])
-						info[part.split('=')[0]] = cookieVal
-					host = self.host
-					if isinstance(host, bytes):
-						host = host.decode('utf-8')
-					self.cookies[host] = info
-				except:
+					self._host = parse_url(b'http://' + value.encode() + b'/').host.decode()
+				except Exception:
 					pass
-
-			# get content length
-			if 'content-length' in head.lower():
+		return self._host
+
+	@property
+	def query_dict(self):
+		''' query string parameters of the path '''
+		if self._query is UNSET:
+			self._query = {}
+			path = self.path
+			if isinstance(path, str): path = path.encode()
+			if path and b'?' in path:
+				query = path.split(b'?', 1)[1].split(b'#', 1)[0]
+				for param in query.split(b'&'):
+					if not param: continue
+					key, _, value = param.partition(b'=')
+					try:
+						self._query[key.decode()] = value.decode()
+					except UnicodeDecodeError:
+						pass
+		return self._query
+
+	@property
+	def cookies(self):
+		''' cookie name -> value, from every Cookie header '''
+		if self._cookies is UNSET:
+			self._cookies = {}
+			for value in self.headers.getall('Cookie'):
+				for part in value.split(';'):
+					key, _, cookieVal = part.strip().partition('=')
+					if key: self._cookies[key] = cookieVal
+		return self._cookies
+
+	@property
+	def content_type(self):
+		if self._content_type is UNSET:
+			self._content_type = self.headers.get('Content-Type', '')
+		return self._content_type
+
+	@property
+	def charset(self):
+		''' charset parameter of the Content-Type header '''
+		if self._charset is UNSET:
+			self._charset = None
+			for param in self.content_type.split(';')[1:]:
+				key, _, value = param.strip().partition('=')
+				if key.lower() == 'charset' and value.strip():
+					self._charset = value.strip().strip('"')
+		return self._charset
+
+	@property
+	def content_length(self):
+		if self._content_length is UNSET:
+			self._content_length = None
+			value = self.headers.get('Content-Length')
+			if value is not None:
 				try:
-					value = int(self.headers[head])
-					self.content_length = value
-				except:
+					self._content_length = int(value)
+				except ValueError:
 					pass
-
-			# get content type
-			if 'content-type' in head.lower():
-				try:
-					value = self.headers[head]
-					self.content_type = value
-
-					if ';charset' in value.lower():
-						self.charset = value.split(';charset=')[1]
-				except:
-					pass
\ No newline at end of file
+		return self._content_length
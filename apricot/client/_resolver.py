@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#! python3
+
+import socket
+import asyncio
+import ipaddress
+from collections import OrderedDict
+
+class ApricotResolver(object):
+	''' Resolves names with the getaddrinfo of the event loop '''
+
+	def __init__(self, loop=None):
+		self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+	async def resolve(self, host, port, family=socket.AF_UNSPEC):
+		''' getaddrinfo tuples of the stream addresses of host '''
+		return await self.loop.getaddrinfo(host, port, family=family,
+			type=socket.SOCK_STREAM)
+
+
+class ApricotDNSEntry(object):
+	__slots__ = ('addresses', 'error', 'expires', 'turn')
+
+	def __init__(self, addresses, error, expires):
+		self.addresses = addresses
+		self.error     = error   # OSError of a failed lookup
+		self.expires   = expires
+		self.turn      = 0       # next address to put first
+
+
+class ApricotDNSCache(object):
+	''' Caching front of a resolver for ApricotSession
+
+	Answers are kept for ttl seconds and failures for negative_ttl seconds,
+	at most size names, least recently used first out. Concurrent lookups of
+	one name share a single query. Every hit rotates the addresses so
+	connections are spread across them. resolver is anything with an async
+	resolve(host, port, family) giving getaddrinfo tuples, fakes included.
+	'''
+
+	def __init__(self, resolver=None, ttl=60.0, size=1024, negative_ttl=5.0, loop=None):
+		self.loop         = loop if loop is not None else asyncio.get_event_loop()
+		self.resolver     = resolver if resolver is not None else ApricotResolver(self.loop)
+		self.ttl          = ttl
+		self.size         = size
+		self.negative_ttl = negative_ttl
+		self.entries      = OrderedDict() # (host, port, family) -> ApricotDNSEntry
+		self.pending      = {}            # (host, port, family) -> lookup task
+
+		# statistics
+		self.hits      = 0 # answered from the cache
+		self.coalesced = 0 # joined a lookup already running
+		self.lookups   = 0 # queries sent to the resolver
+
+	async def resolve(self, host, port, family=socket.AF_UNSPEC):
+		''' addresses of host, the one to try first rotating between calls '''
+		if self.is_address(host):
+			return await self.resolver.resolve(host, port, family)
+
+		key   = (host, port, family)
+		entry = self.entries.get(key)
+		if entry is not None:
+			if entry.expires > self.loop.time():
+				self.hits += 1
+				self.entries.move_to_end(key)
+				return self.answer(entry)
+			del self.entries[key]
+
+		task = self.pending.get(key)
+		if task is None:
+			task = self.pending[key] = self.loop.create_task(self.lookup(key))
+		else:
+			self.coalesced += 1
+
+		# a cancelled caller leaves the query running for the others
+		entry = await asyncio.shield(task)
+		return self.answer(entry)
+
+	async def lookup(self, key):
+		''' query the resolver and store the answer or the failure '''
+		self.lookups += 1
+		try:
+			try:
+				addresses = list(await self.resolver.resolve(*key))
+				error     = None
+				if not addresses:
+					error = socket.gaierror(socket.EAI_NONAME, "No address for %s" % key[0])
+			except OSError as err:
+				addresses, error = [], err
+			ttl   = self.ttl if error is None else self.negative_ttl
+			entry = ApricotDNSEntry(addresses, error, self.loop.time() + (ttl or 0))
+			if ttl:
+				self.store(key, entry)
+			return entry
+		finally:
+			self.pending.pop(key, None)
+
+	def store(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	def answer(self, entry):
+		if entry.error is not None:
+			raise type(entry.error)(*entry.error.args)
+		addresses  = entry.addresses
+		turn       = entry.turn % len(addresses)
+		entry.turn = turn + 1
+		return addresses[turn:] + addresses[:turn]
+
+	@staticmethod
+	def is_address(host):
+		try:
+			ipaddress.ip_address(host)
+			return True
+		except ValueError:
+			return False
+
+	def clear(self, host=None):
+		''' forget every cached answer, or those of host '''
+		if host is None:
+			self.entries.clear()
+			return
+		for key in [key for key in self.entries if key[0] == host]:
+			del self.entries[key]
@@ -4,20 +4,43 @@
 try: import ujson as json
 except: import json
 
+import zlib
 from ._parser import ApricotParser
-from ..utils import _BREAK, gzipDecode
+from ._request import UNSET
+from ._protocol import ApricotResponseError
+from ..utils import gzipDecode, generateID, ApricotHeaders
 
 class ApricotHttpResponse(object):
+	''' Response received by ApricotSession
+
+	The body is decoded to text and json on first access. read(), iter_any()
+	and iter_chunked() give it gzip and deflate decoded, streamed or not.
+	Streamed responses keep their body in content until it is read and
+	decode it piece by piece as it arrives.
+	'''
+
+	__slots__ = ('data', 'parser', 'headers', 'status', 'version', 'keep_alive',
+		'reason', 'url', 'host', 'schema', 'port', 'path', 'content', 'connection',
+		'decoded', '_body', '_text', '_json')
+
+	# most bytes decompressed from one piece at a time
+	chunk_size = 64 * 1024
+
 	def __init__(self, httpData=b'', aUrl=None):
 		self.data = httpData
 
-		self.headers    = {}
+		self.parser     = None
+		self.headers    = ApricotHeaders()
 		self.status     = None
 		self.version    = None
 		self.keep_alive = None
+		self.reason     = None
+		self.content    = None  # ApricotRequestBody of a streamed body
+		self.connection = None  # ApricotProtocol reading a streamed body
+		self.decoded    = False # body already decompressed
 		self._body      = None
-		self._text      = None
-		self._json      = None
+		self._text      = UNSET
+		self._json      = UNSET
 
 		# set null url info
 		self.url     = aUrl.url if aUrl is not None else None
@@ -36,93 +59,318 @@ class ApricotHttpResponse(object):
 		await self.parser.feed_async(self.data)
 		self.set_attributes()
 
+	@classmethod
+	def from_parser(cls, parser, aUrl=None, connection=None):
+		''' build a response from a parser that already consumed the message,
+		or its headers when the connection streams the body
+		'''
+		response = cls(b'', aUrl)
+		response.parser = parser
+		response.set_attributes()
+		if connection is not None and connection.content is not None:
+			response.content    = connection.content
+			response.connection = connection
+			response._body      = None
+		return response
+
 	def set_attributes(self):
 		self._body      = self.parser.body
 		self.headers    = self.parser.headers
 		self.version    = self.parser.http_ver
 		self.status     = self.parser.status
 		self.keep_alive = self.parser.keep_alive
-		self.reason     = b' '.join(self.data.split(_BREAK)[0].split()[2:]).decode()
+		self.reason     = self.parser.reason
+		self._text      = UNSET
+		self._json      = UNSET
+		self.decoded    = False
 
+	def decode_text(self):
+		''' body as text, gunzipped and decoded by its charset '''
+		if self._body is None:
+			return None
 
+		# attempt to get charset
 		charset = 'utf-8'
-		if self._body is not None:
-
-			# attempt to get charset
-			if 'Content-Type' in self.headers:
-				c_type = self.headers['Content-Type']
-				if 'charset=' in c_type:
-					charset = c_type.split('charset=')[1].split(';')[0]
+		if 'Content-Type' in self.headers:
+			c_type = self.headers['Content-Type']
+			if 'charset=' in c_type:
+				charset = c_type.split('charset=')[1].split(';')[0]
 
-			# attemp to unzip encoding
-			try:
-				if 'Content-Encoding' in self.headers:
-					if 'gzip' in self.headers['Content-Encoding']:
-						try:
-							self._text = (gzipDecode(self._body)).decode(charset)
-						except:
-							pass
-				if not isinstance(self._text, str):
-					try:
-						self._text = self._body.decode(str(charset).lower())
-					except:
-						pass
-			except:
+		# attemp to unzip encoding
+		text = None
+		try:
+			if not self.decoded and 'gzip' in self.headers.get('Content-Encoding', ''):
+				try:
+					text = gzipDecode(self._body).decode(charset)
+				except:
+					pass
+			if not isinstance(text, str):
 				try:
-					self._text = self._body.decode('utf-8')
+					text = self._body.decode(str(charset).lower())
 				except:
 					pass
+		except:
+			try:
+				text = self._body.decode('utf-8')
+			except:
+				pass
+		return text
+
+	def decode_json(self):
+		''' json of responses with a json content type '''
+		if 'json' not in self.headers.get('Content-Type', ''):
+			return None
+		try:
+			raw_text = self.get_text()
+			if raw_text.startswith('[') and raw_text.endswith(']'):
+				raw_text = raw_text[1:-1]
+			return json.loads(raw_text)
+		except Exception:
+			return None
+
+	def get_text(self):
+		if self._text is UNSET:
+			self._text = self.decode_text()
+		return self._text
+
+	def get_json(self):
+		if self._json is UNSET:
+			self._json = self.decode_json()
+		return self._json
+
+	async def json(self):
+		await self.read()
+		return self.get_json()
+
+	async def text(self):
+		await self.read()
+		return self.get_text()
+
+	async def body(self): return await self.read()
+
+	##### Streaming #####
+
+	async def read(self):
+		''' the whole body decoded, read from the stream on first call '''
+		if self.decoded:
+			return self._body
+		if self.content is not None:
+			chunks = []
+			async for data in self.iter_any():
+				chunks.append(data)
+			self._body = b''.join(chunks) or None
+		elif self._body:
+			self._body = self.decompress(self._body)
+		self.decoded = True
+		return self._body
+
+	def decompress(self, data):
+		''' decode a whole body by its Content-Encoding '''
+		decoder = self.decoder(data)
+		if decoder is None:
+			return data
+		try:
+			return decoder.decompress(data) + decoder.flush()
+		except zlib.error as err:
+			raise ApricotResponseError("Undecodable response body: %s" % err) from err
 
-			# attempt to get json info
-			if 'Content-Type' in self.headers:
-				if 'json' in self.headers['Content-Type']:
-					try:
-						raw_text = self._text
-						if raw_text.startswith('[') and raw_text.endswith(']'):
-							raw_text = raw_text[1:-1]
-						self._json = json.loads(raw_text)
-					except Exception as e:
-						self._json = None
-						
+	def decoder(self, data):
+		''' decompressor for the Content-Encoding, None when not compressed '''
+		encoding = self.headers.get('Content-Encoding', '').lower()
+		if 'gzip' in encoding:
+			return zlib.decompressobj(16 + zlib.MAX_WBITS)
+		if 'deflate' in encoding:
+			# zlib wrapped as the standard says, raw deflate as some servers send
+			wrapped = len(data) >= 2 and data[0] & 0x0F == 8 \
+				and (data[0] << 8 | data[1]) % 31 == 0
+			return zlib.decompressobj(zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS)
+		return None
 
-	async def json(self): return self._json
+	async def iter_any(self):
+		''' body pieces as they arrive, decompressed '''
+		if self.content is None:
+			body = await self.read()
+			if body:
+				yield body
+			return
+		if self.content.started:
+			raise RuntimeError("Response body was already read")
 
-	async def text(self): return self._text
+		decoder = None
+		first   = True
+		try:
+			while True:
+				data = await self.content.readany()
+				if not data: break
+				if first:
+					decoder, first = self.decoder(data), False
+				if decoder is None:
+					yield data
+					continue
 
-	async def body(self): return self._body
+				# inflate at most chunk_size bytes at a time
+				data = decoder.decompress(data, self.chunk_size)
+				while data:
+					yield data
+					data = decoder.decompress(decoder.unconsumed_tail, self.chunk_size) \
+						if decoder.unconsumed_tail else b''
+			if decoder is not None:
+				data = decoder.flush()
+				if data:
+					yield data
+		except zlib.error as err:
+			self.close()
+			raise ApricotResponseError("Undecodable response body: %s" % err) from err
+
+	async def iter_chunked(self, size):
+		''' body in pieces of size bytes, the last one can be shorter '''
+		buffer = bytearray()
+		async for data in self.iter_any():
+			buffer += data
+			while len(buffer) >= size:
+				yield bytes(buffer[:size])
+				del buffer[:size]
+		if buffer:
+			yield bytes(buffer)
+
+	def close(self):
+		''' drop the connection of a body that was not read to its end '''
+		if self.connection is not None and not self.connection.complete:
+			self.connection.reusable = False
+			if self.connection.transport is not None:
+				self.connection.transport.close()
+		self.connection = None
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, type, value, traceback):
+		self.close()
 
 
 
 class ApricotResponse(object):
 	''' Apricot HTTP Response Object '''
 
-	def __init__(self, status=200, headers={},
+	__slots__ = ('status', 'headers', 'content_type', 'charset', 'body', 'text',
+		'using', 'payload')
+
+	def __init__(self, status=200, headers=None,
 		content_type=None, charset=None, body=None, text=None):
 		self.status       = status
-		self.headers      = headers
+		self.headers      = ApricotHeaders(headers)
 		self.content_type = content_type
 		self.charset      = charset
 		self.body         = body
 		self.text         = text
 		self.using        = 'body'
 
+		# every response is framed so persistent connections stay in sync
+		# the encoded body is kept for the serializer
+		self.payload = None
 		if self.body is not None:
-			self.headers['Content-Length'] = len(self.body)
+			self.payload = self.body
+			if isinstance(self.payload, str):
+				self.payload = self.payload.encode(self.charset or 'utf-8')
 		if self.text is not None:
-			self.headers['Content-Length'] = len(self.text)
+			if self.charset is None:
+				self.charset = 'utf-8'
+			self.payload = self.text.encode(self.charset)
 			if self.content_type == None:
 				self.content_type = 'text/plain'
-			self.charset      = 'utf-8'
 			self.using        = 'text'
 		if self.content_type == None:
 			self.content_type = 'application/html'
 
-		header_keys = [x.lower() for x in self.headers]
+		if self.payload is not None:
+			self.headers['Content-Length'] = len(self.payload)
+		elif 'Content-Length' not in self.headers:
+			self.headers['Content-Length'] = 0
+
+		if 'Content-Type' not in self.headers:
+			c_type = self.content_type
+			if self.charset is not None:
+				c_type += ';charset=' + self.charset
+			self.headers['Content-Type'] = c_type
+
+
+class ApricotStreamResponse(ApricotResponse):
+	''' Apricot HTTP Response streamed from an async iterable of bytes
+
+	The body is sent with Transfer-Encoding: chunked as the iterable yields,
+	so only one chunk is held in memory at a time.
+	'''
+
+	__slots__ = ()
+
+	def __init__(self, status=200, headers=None,
+		content_type='application/octet-stream', charset=None, body=None):
+		super().__init__(status, headers, content_type, charset)
+		self.headers.pop('Content-Length', None)
+		self.headers['Transfer-Encoding'] = 'chunked'
+		self.body  = body
+		self.using = 'stream'
+
+	def __aiter__(self):
+		return self.iterate()
+
+	async def iterate(self):
+		''' yield the body as bytes '''
+		if self.body is None:
+			return
+		async for chunk in self.body:
+			if not isinstance(chunk, bytes):
+				chunk = str(chunk).encode(self.charset or 'utf-8')
+			if chunk:
+				yield chunk
+
+
+class ApricotFileResponse(ApricotResponse):
+	''' Apricot HTTP Response backed by a file on disk
+
+	The connection sends the file itself, with loop.sendfile when possible.
+	A list of inclusive (start, end) ranges makes this a 206 response,
+	several ranges are sent as multipart/byteranges. An already open file
+	is sent and closed instead of opening path.
+	'''
+
+	__slots__ = ('path', 'size', 'parts', 'epilogue', 'file')
+
+	def __init__(self, path, size, ranges=None, status=200, headers=None,
+		content_type='application/octet-stream', file=None):
+		self.path     = path
+		self.size     = size
+		self.file     = file
+		self.parts    = [] # (part header bytes, offset, count)
+		self.epilogue = b''
+
+		part_type = content_type
+		if ranges and len(ranges) > 1:
+			boundary     = generateID().decode()
+			content_type = 'multipart/byteranges; boundary=' + boundary
+		super().__init__(206 if ranges else status, headers, content_type)
+		self.using = 'file'
+
+		# whole file
+		if not ranges:
+			self.parts.append((b'', 0, size))
+
+		# single range
+		elif len(ranges) == 1:
+			start, end = ranges[0]
+			self.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+			self.parts.append((b'', start, end - start + 1))
+
+		# multiple ranges
+		else:
+			for pos, (start, end) in enumerate(ranges):
+				head = '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+					boundary, part_type, start, end, size)
+				if pos != 0: head = '\r\n' + head
+				self.parts.append((head.encode(), start, end - start + 1))
+			self.epilogue = ('\r\n--%s--\r\n' % boundary).encode()
 
-		if self.content_type is not None:
-			if 'content-type' not in header_keys:
-				c_type = self.content_type
-				if self.charset is not None:
-					c_type += ';charset=' + self.charset
-				if self.headers is not None:
-					self.headers['Content-Type'] = c_type
\ No newline at end of file
+		length = len(self.epilogue)
+		for head, offset, count in self.parts:
+			length += len(head) + count
+		self.headers['Content-Length'] = length
@@ -1,29 +1,47 @@
 #!/usr/bin/env python3
 #! python3
 
-import ssl
-import certifi
 import asyncio
+from time import perf_counter
+from functools import partial
 from datetime import datetime, timedelta
 from ._request import ApricotRequest
-from ._protocol import ApricotProtocol
+from ._protocol import ApricotProtocol, ApricotResponseError
+from ._pool import ApricotConnectionPool
+from ._tls import ApricotTLS
+from ._resolver import ApricotDNSCache
 from ._response import ApricotHttpResponse
 from ..utils import ApricotUrl, BREAK, REQUEST_HEADERS
 from ..utils import generateID_async, json, urlencode
 from ..utils import createParams
 
+# requests sent again when a reused connection turns out closed
+IDEMPOTENT = (b'GET', b'HEAD', b'PUT', b'DELETE', b'OPTIONS')
+
 class ApricotSession(object):
 	''' Apricot Request Session '''
 
-	def __init__(self, loop=None):
+	def __init__(self, loop=None, limit=100, limit_per_host=None, keepalive_timeout=30.0, tls=None,
+		resolver=None):
+		''' create Apricot Session
+		@param limit : open connections of the session
+		@param limit_per_host : open connections to one schema, host and port
+		@param keepalive_timeout : seconds an idle connection is kept for reuse
+		@param tls : ApricotTLS with the SSL contexts and TLS sessions to use
+		@param resolver : ApricotDNSCache, or anything with an async resolve(host, port, family)
+		'''
 		self.loop = loop if loop != None else asyncio.get_event_loop()
 		self.connections = {} # categorize all ApricotProtocols by uuid
-		self.conn_ready  = {} # hold Events to check protocol ready by uuid
 		self.isClosed    = False
 
-		# SSL Authentication
-		self.ca_path = certifi.where()
-		self.ca_auth = ssl.Purpose.CLIENT_AUTH
+		# keep-alive connections by (schema, host, port)
+		self.pool = ApricotConnectionPool(self.loop, limit, limit_per_host, keepalive_timeout)
+
+		# SSL contexts, built once, and TLS sessions to resume
+		self.tls = tls if tls is not None else ApricotTLS()
+
+		# host name lookups, cached
+		self.resolver = resolver if resolver is not None else ApricotDNSCache(loop=self.loop)
 
 		# cookie handling
 		self.cookies = {}
@@ -35,14 +53,15 @@ class ApricotSession(object):
 		''' close all clients '''
 		if self.isClosed: return
 		try:
-			for uuid in self.connections:
-				try:
-					protocol = self.connections.pop(uuid, None)
-					protocol.transport.close()
-				except:
-					pass
+			self.pool.close()
 		except:
 			pass
+		for protocol in list(self.connections.values()):
+			try:
+				protocol.transport.close()
+			except:
+				pass
+		self.connections.clear()
 		self.isClosed = True
 
 	### Asynchronous with statements ###
@@ -55,9 +74,10 @@ class ApricotSession(object):
 
 	### HTTP Requests ###
 
-	async def get(self, url, params={}, headers={}, data=None, allow_redirects=True):
+	async def get(self, url, params={}, headers={}, data=None, allow_redirects=True, stream=False):
+		''' GET a url, with stream=True once the headers are in, see ApricotHttpResponse.iter_any '''
 		return await self.do_request(
-			url, "GET", params, headers, data, None, allow_redirects)
+			url, "GET", params, headers, data, None, allow_redirects, stream)
 
 	async def post(self, url, params={}, headers={}, data=None, json=None):
 		return await self.do_request(
@@ -71,74 +91,69 @@ class ApricotSession(object):
 
 	async def cookie_handle(self, response):
 		""" Add cookies to session """
-		headers = response.headers
-
-		for head in headers:
-			# set cookie
-			if str(head).lower().startswith('set-cookie'):
-				# extract parts
-				cookie       = headers[head]
-				cookie_info  = {}
-				parts        = cookie.split(";")
-				cookie_key   = ''
-				cookie_value = None
-
-				# assign info, key, and value
-				for pos, part in enumerate(parts):
-					if part.startswith(' '): part = part[1:]
-					key   = part.split("=")[0]
-					value = '='.join(part.split("=")[1:])
-					if pos != 0:
-						cookie_info[key] = value
-					else:
-						cookie_key   = key
-						cookie_value = value
-
-				# handle parts
-				for part in cookie_info:
-					cookie_h  = str(part).lower()
-					new_value = None
-
-					# convert expire date & python datetime convert
-					if cookie_h == "expires":
-						date   = cookie_info[part]
-						date_p = date.split()
-						if '-' in date_p[1]:
-							date_parts = date_p[1].split('-')
-							if len(date_parts[-1]) <= 2:
-								pref = str(datetime.now().year)[:2]
-								date_parts[-1] = pref + date_parts[-1]
-							date_rest = date_p[2:]
-							date_final = [date_p[0]] + date_parts + date_rest
-							date = ' '.join(date_final)
-						new_value = datetime.strptime(date, "%a, %d %b %Y %H:%M:%S %Z")
-
-					# convert max age date
-					elif cookie_h == "max-age":
-						seconds   = int(cookie_info[part])
-						new_value = datetime.now() + timedelta(seconds=seconds)
-
-					# no other real conversion needed
-					else:
-						pass
-
-					# set converted python value if necessary
-					if new_value is not None:
-						cookie_info[part] = new_value
-
-				# create cookie entry for session
-				host = response.host
-				if host not in self.cookies:
-					self.cookies[host] = {}
-				info = {}
-				info['value'] = cookie_value
-				for part in cookie_info:
-					if part != 'value':
-						info[part] = cookie_info[part]
-				if 'Path' not in info: info['Path'] = "/"
-
-				# add to session coookies
-				self.cookies[host][cookie_key] = info
+		for cookie in response.headers.getall('Set-Cookie'):
+			# extract parts
+			cookie_info  = {}
+			parts        = cookie.split(";")
+			cookie_key   = ''
+			cookie_value = None
+
+			# assign info, key, and value
+			for pos, part in enumerate(parts):
+				if part.startswith(' '): part = part[1:]
+				key   = part.split("=")[0]
+				value = '='.join(part.split("=")[1:])
+				if pos != 0:
+					cookie_info[key] = value
+				else:
+					cookie_key   = key
+					cookie_value = value
+
+			# handle parts
+			for part in cookie_info:
+				cookie_h  = str(part).lower()
+				new_value = None
+
+				# convert expire date & python datetime convert
+				if cookie_h == "expires":
+					date   = cookie_info[part]
+					date_p = date.split()
+					if '-' in date_p[1]:
+						date_parts = date_p[1].split('-')
+						if len(date_parts[-1]) <= 2:
+							pref = str(datetime.now().year)[:2]
+							date_parts[-1] = pref + date_parts[-1]
+						date_rest = date_p[2:]
+						date_final = [date_p[0]] + date_parts + date_rest
+						date = ' '.join(date_final)
+					new_value = datetime.strptime(date, "%a, %d %b %Y %H:%M:%S %Z")
+
+				# convert max age date
+				elif cookie_h == "max-age":
+					seconds   = int(cookie_info[part])
+					new_value = datetime.now() + timedelta(seconds=seconds)
+
+				# no other real conversion needed
+				else:
+					pass
+
+				# set converted python value if necessary
+				if new_value is not None:
+					cookie_info[part] = new_value
+
+			# create cookie entry for session
+			host = response.host
+			if host not in self.cookies:
+				self.cookies[host] = {}
+			info = {}
+			info['value'] = cookie_value
+			for part in cookie_info:
+				if part != 'value':
+					info[part] = cookie_info[part]
+			if 'Path' not in info: info['Path'] = "/"
+
+			# add to session coookies
+			self.cookies[host][cookie_key] = info
 
 	async def set_cookies(self, respData):
 		""" Add cookies to response data from session """
@@ -245,37 +260,79 @@ class ApricotSession(object):
 
 		return respData, aUrl
 
-	async def do_request(self, url, method, params, headers, data, _json, redirect):
+	def configure_tls(self, host, context=None, **options):
+		''' per host SSL settings, see ApricotTLS.configure '''
+		self.tls.configure(host, context, **options)
+
+	async def connect(self, aUrl):
+		''' open a connection for the pool '''
+		ctx         = self.tls.context(aUrl.host) if aUrl.schema == 'https' else None
+		client_id   = await generateID_async()
+		client_coro = lambda: ApricotProtocol(self.loop, self, b'', client_id)
+		addresses   = await self.resolver.resolve(aUrl.host, aUrl.port)
+
+		# try the addresses in the order given, the resolver rotates them
+		error = None
+		for family, _, proto, _, address in addresses:
+			started = perf_counter()
+			try:
+				transport, protocol = await self.loop.create_connection(
+					client_coro, address[0], address[1], family=family, proto=proto,
+					ssl=ctx, server_hostname=aUrl.host if ctx is not None else None)
+				break
+			except OSError as err:
+				error = err
+		else:
+			raise error if error is not None else OSError("No address for %s" % aUrl.host)
+		self.tls.record(transport, perf_counter() - started)
+		if ctx is not None:
+			self.tls.remember(transport)
+		return protocol
+
+	async def send(self, aUrl, respData, stream=False):
+		''' write a request on a pooled connection and read the parsed response,
+		a streamed response returns the connection to the pool once it ended
+		'''
+		key   = (aUrl.schema, aUrl.host, aUrl.port)
+		retry = respData.split(b' ', 1)[0] in IDEMPOTENT
+		while True:
+			protocol = await self.pool.acquire(key, partial(self.connect, aUrl))
+			on_done  = partial(self.pool.release, key, protocol) if stream else None
+			try:
+				parser = await protocol.request(respData, stream, on_done)
+			except BaseException:
+				if protocol.content is None or protocol.on_done is not None:
+					protocol.on_done = None
+					self.pool.release(key, protocol, False)
+				raise
+
+			# TLS 1.3 servers send session tickets after the handshake
+			if aUrl.schema == 'https' and protocol.transport is not None:
+				self.tls.remember(protocol.transport)
+
+			# the body still arrives, on_done releases the connection
+			if protocol.content is not None:
+				return parser, protocol
+			self.pool.release(key, protocol)
+
+			if parser is not None:
+				return parser, protocol
+
+			# a reused connection the server closed meanwhile, once more on a new one
+			if protocol.requests == 1 or not retry:
+				raise ApricotResponseError("Connection closed before a response arrived")
+			retry = False
+
+	async def do_request(self, url, method, params, headers, data, _json, redirect, stream=False):
 		''' perform the basis http request '''
 
 		# get byte data and ApricotUrl object
 		respData, aUrl = await self.buildHttpRequest(
 			url, method, params, headers, data, _json)
 
-		# client info
-		client_id   = await generateID_async()
-		self.conn_ready[client_id] = asyncio.Event()
-		client_coro = lambda: ApricotProtocol(self.loop, self, respData, client_id)
-
-		# create connection
-		if aUrl.schema == 'https':
-			ctx  = ssl.create_default_context(self.ca_auth, capath=self.ca_path)
-		else:
-			ctx  = None
-		coro = self.loop.create_connection(client_coro, aUrl.host, aUrl.port, ssl=ctx)
-		task = self.loop.create_task(coro)
-
-		# wait for protocol to be initialized
-		await self.conn_ready[client_id].wait()
-
-		# wait for data to be received
-		protocol = self.connections[client_id]
-		await protocol.isReady.wait()
-		http_data = protocol.data
-
-		# build http response
-		response = ApricotHttpResponse(http_data, aUrl)
-		await response.feed_async()
+		# send on a pooled connection, the response is parsed as it arrives
+		parser, protocol = await self.send(aUrl, respData, stream)
+		response = ApricotHttpResponse.from_parser(parser, aUrl, protocol)
 
 		# save cookies
 		await self.cookie_handle(response)
@@ -290,7 +347,8 @@ class ApricotSession(object):
 					new_url = schema + main + new_url
 				if 'Referer' not in headers:
 					headers["Referer"] = new_url
-				response = await self.get(new_url, params, headers)
+				await response.read() # frees a streamed connection
+				response = await self.get(new_url, params, headers, stream=stream)
 
 		# return http response
 		return response
\ No newline at end of file
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#! python3
+
+import ssl
+import certifi
+from collections import OrderedDict
+
+class ApricotSSLContext(ssl.SSLContext):
+	''' Client SSL context that resumes the last TLS session of a host
+
+	asyncio wraps every connection through wrap_bio(), the session kept
+	for server_hostname is passed on there so the handshake is abbreviated.
+	'''
+
+	# hosts whose session is kept
+	max_sessions = 256
+
+	def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT):
+		context = super().__new__(cls, protocol)
+		context.sessions = OrderedDict() # server hostname -> ssl.SSLSession
+		return context
+
+	def wrap_bio(self, incoming, outgoing, server_side=False,
+		server_hostname=None, session=None):
+		if session is None and server_hostname is not None:
+			session = self.sessions.get(server_hostname)
+		return super().wrap_bio(incoming, outgoing, server_side,
+			server_hostname, session)
+
+	def remember(self, server_hostname, session):
+		self.sessions[server_hostname] = session
+		self.sessions.move_to_end(server_hostname)
+		while len(self.sessions) > self.max_sessions:
+			self.sessions.popitem(last=False)
+
+
+class ApricotTLS(object):
+	''' SSL contexts and TLS sessions of an ApricotSession
+
+	The default context loads the CA bundle once, hosts configured with
+	configure() get a context of their own for client certificates or other
+	verification settings. Connect times are counted apart for plain, full
+	handshake and resumed handshake connections.
+	'''
+
+	KINDS = ("plain", "full", "resumed")
+
+	def __init__(self, cafile=None, resume=True):
+		self.cafile    = cafile if cafile is not None else certifi.where()
+		self.resume    = resume
+		self.default   = None
+		self.overrides = {} # host -> ssl.SSLContext
+		self.connects  = {kind: {"count": 0, "total": 0.0, "max": 0.0} for kind in self.KINDS}
+
+	def create(self, cafile=None, verify=True, cert=None, key=None, password=None):
+		''' a client context, resuming sessions unless resume is off '''
+		cls     = ApricotSSLContext if self.resume else ssl.SSLContext
+		context = cls(ssl.PROTOCOL_TLS_CLIENT)
+		context.load_verify_locations(cafile or self.cafile)
+		if not verify:
+			context.check_hostname = False
+			context.verify_mode    = ssl.CERT_NONE
+		if cert is not None:
+			context.load_cert_chain(cert, key, password)
+		return context
+
+	def configure(self, host, context=None, **options):
+		''' use context, or one created from options, for connections to host
+		@param cafile : CA bundle to verify the host with
+		@param verify : False to skip certificate and hostname checks
+		@param cert : client certificate file, key and password for its key
+		'''
+		self.overrides[host] = context if context is not None else self.create(**options)
+
+	def context(self, host):
+		''' the context for a host, built once '''
+		context = self.overrides.get(host)
+		if context is not None:
+			return context
+		if self.default is None:
+			self.default = self.create()
+		return self.default
+
+	def remember(self, transport):
+		''' keep the TLS session of a connection for the next handshake to its host '''
+		ssl_object = transport.get_extra_info('ssl_object')
+		if ssl_object is None or not isinstance(ssl_object.context, ApricotSSLContext):
+			return
+		session = ssl_object.session
+		if session is not None and ssl_object.server_hostname is not None:
+			ssl_object.context.remember(ssl_object.server_hostname, session)
+
+	def record(self, transport, elapsed):
+		''' count the connect time under the kind of handshake done '''
+		ssl_object = transport.get_extra_info('ssl_object')
+		if ssl_object is None:
+			kind = "plain"
+		else:
+			kind = "resumed" if ssl_object.session_reused else "full"
+		stats = self.connects[kind]
+		stats["count"] += 1
+		stats["total"] += elapsed
+		stats["max"]    = max(stats["max"], elapsed)
+		return kind
+
+	def latency(self):
+		''' mean connect seconds by kind, None before the first connection '''
+		return {kind: (stats["total"] / stats["count"] if stats["count"] else None)
+			for kind, stats in self.connects.items()}
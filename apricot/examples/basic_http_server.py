@@ -17,10 +17,10 @@ async def index(request):
 # http://localhost:4444/post
 #############################
 async def post(request):
-	dict_data = request.headers
+	dict_data = dict(request.headers)
 
 	if request.has_body:
-		dict_data['form_body'] = request.body
+		dict_data['form_body'] = await request.text()
 	dict_data['url query parameters'] = request.query_dict
 
 	dict_data = json.dumps(dict_data)
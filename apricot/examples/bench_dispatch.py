@@ -0,0 +1,72 @@
+
+# Handler dispatch micro-benchmark
+# python -m apricot.examples.bench_dispatch
+
+import time
+import asyncio
+from ..client import ApricotRequest, ApricotResponse
+from ..server import ApricotRouter
+
+ROUNDS = 3
+
+class Client(object):
+	''' the parts of a connection dispatch touches '''
+	def __init__(self):
+		self.event    = asyncio.Event()
+		self.response = None
+
+######## Previous dispatch ########
+# a task per request, the result handed back through client.event
+###################################
+async def legacyPerformTask(func, client, request):
+	client.response = await func(request)
+
+async def legacyDispatch(router, client, request):
+	client.event.clear()
+	coro = router.route_request(request)
+	def on_finish(*args):
+		client.event.set()
+	task = asyncio.Task(legacyPerformTask(coro, client, request))
+	task.add_done_callback(on_finish)
+	await client.event.wait()
+	return client.response
+
+async def directDispatch(router, client, request):
+	return await router.process_request(request)
+
+######## Benchmark ########
+
+async def bench(dispatch, router, seconds=1.0):
+	''' requests dispatched per second '''
+	client, request = Client(), ApricotRequest()
+	request.path = '/'
+	best = 0
+	for _ in range(ROUNDS):
+		count = 0
+		start = time.perf_counter()
+		end   = start + seconds
+		while True:
+			for _ in range(100):
+				await dispatch(router, client, request)
+			count += 100
+			now = time.perf_counter()
+			if now >= end: break
+		best = max(best, count / (now - start))
+	return best
+
+async def run():
+	router = ApricotRouter(None)
+	async def hello(request):
+		return ApricotResponse(status=200, text="Hello, world!")
+	router.add_route('GET', '/', hello)
+
+	before = await bench(legacyDispatch, router)
+	after  = await bench(directDispatch, router)
+	print("{0:>14} {1:>14} {2:>8}".format("before/s", "after/s", "speedup"))
+	print("{0:>14,.0f} {1:>14,.0f} {2:>7.1f}x".format(before, after, after / before))
+
+def start():
+	asyncio.run(run())
+
+if __name__ == "__main__":
+	start()
@@ -0,0 +1,83 @@
+
+# Response serializer micro-benchmark
+# python -m apricot.examples.bench_serializer
+
+import time
+from ..client import ApricotResponse
+from ..utils import createResponseParts, RESPONSE_HEADERS, CODES, BREAK
+
+ROUNDS = 3
+
+######## Previous serializer ########
+# kept here to compare against
+#####################################
+def legacyCreateHeaders(resp=b'', headers=None, keep_alive=False):
+	_headers = RESPONSE_HEADERS.copy()
+	_headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime())
+	_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+	if headers is not None:
+		for key in headers:
+			_headers[key] = headers[key]
+	for head in _headers:
+		resp += (head + ": " + str(_headers[head]) + BREAK).encode()
+	resp += BREAK.encode()
+	return resp
+
+def legacyMakeResponse(code=200):
+	if str(code) not in CODES:
+		code = 404
+	reason = CODES[str(code)]
+	return ('HTTP/1.1 ' + str(code) + ' ' + reason + BREAK).encode()
+
+def legacyCreateResponse(response, keep_alive=False):
+	resp = legacyMakeResponse(response.status)
+	resp = legacyCreateHeaders(resp, response.headers, keep_alive)
+	if response.using != 'body':
+		resp += response.text.encode()
+	elif response.body is not None:
+		body = response.body
+		resp += body if isinstance(body, bytes) else body.encode()
+	resp = resp.decode()
+	if response.charset is not None:
+		return resp.encode(response.charset)
+	return resp.encode()
+
+######## Benchmark ########
+
+def bench(func, options, seconds=1.0):
+	''' responses built and serialized per second
+
+	The response is created inside the timed loop for both serializers,
+	ApricotResponse encodes its payload when it is built.
+	'''
+	best = 0
+	for _ in range(ROUNDS):
+		count = 0
+		start = time.perf_counter()
+		end   = start + seconds
+		while True:
+			for _ in range(100):
+				func(ApricotResponse(**options), True)
+			count += 100
+			now = time.perf_counter()
+			if now >= end: break
+		best = max(best, count / (now - start))
+	return best
+
+def start():
+	cases = [
+		("text 13B", dict(status=200, text="Hello, world!")),
+		("json 1KB", dict(status=200, content_type='application/json',
+			text='{"k": "' + 'v' * 1000 + '"}', headers={'X-Request-Id': 'abc123'})),
+		("body 1MB", dict(status=200, body=b'x' * (1024 * 1024))),
+	]
+
+	print("{0:<10} {1:>14} {2:>14} {3:>8}".format("case", "before/s", "after/s", "speedup"))
+	for name, options in cases:
+		before = bench(legacyCreateResponse, options)
+		after  = bench(createResponseParts, options)
+		print("{0:<10} {1:>14,.0f} {2:>14,.0f} {3:>7.1f}x".format(
+			name, before, after, after / before))
+
+if __name__ == "__main__":
+	start()
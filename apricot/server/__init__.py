@@ -1,2 +1,9 @@
 from ._server import ApricotServer
-from ._router import ApricotRouter
\ No newline at end of file
+from ._router import ApricotRouter
+from ._compression import ApricotCompression
+from ._middleware import ApricotTimings
+from ._metrics import ApricotMetrics
+from ._cache import ApricotResponseCache
+from ._executors import ApricotExecutors, ApricotWorkerRequest
+from ._listeners import ApricotListener, ApricotListenerError
+from ._workers import ApricotWorkerError
\ No newline at end of file
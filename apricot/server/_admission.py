@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#! python3
+
+import socket
+import asyncio
+from ..client import ApricotResponse
+from ..utils import createResponse
+
+class ApricotAdmission(object):
+	''' Connection and request limits of a server
+
+	Connections over max_connections and requests over max_inflight are
+	answered with a 503 and Retry-After straight away. With pause_queue_depth
+	or pause_loop_lag set the server stops accepting while that many requests
+	are being handled or while the event loop runs late, connections wait in
+	the listen backlog until the load drops.
+	'''
+
+	# seconds between event loop lag samples
+	lag_interval = 0.1
+
+	# seconds a rejected connection is drained before closing, closing with
+	# unread request bytes would reset it before the client reads the 503
+	linger = 1.0
+
+	def __init__(self, max_connections=None, max_inflight=None, retry_after=1,
+		pause_queue_depth=None, pause_loop_lag=None):
+		self.max_connections   = max_connections
+		self.max_inflight      = max_inflight
+		self.retry_after       = retry_after
+		self.pause_queue_depth = pause_queue_depth
+		self.pause_loop_lag    = pause_loop_lag
+
+		self.inflight  = 0     # requests being handled
+		self.lag       = 0.0   # last measured event loop lag in seconds
+		self.paused    = False
+		self.accepting = None  # asyncio.Event, set while accepting
+		self.handle    = None  # lag sampling timer
+		self.expected  = 0.0
+
+		# shed load
+		self.rejected_connections = 0
+		self.rejected_requests    = 0
+
+	@property
+	def pausable(self):
+		''' check if accepting may be paused, the server then runs its own accept loop '''
+		return self.pause_queue_depth is not None or self.pause_loop_lag is not None
+
+	def start(self, loop):
+		''' start sampling the event loop lag '''
+		self.loop      = loop
+		self.accepting = asyncio.Event()
+		self.accepting.set()
+		if self.pause_loop_lag is not None:
+			self.expected = loop.time() + self.lag_interval
+			self.handle   = loop.call_later(self.lag_interval, self.tick)
+
+	def stop(self):
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+
+	def tick(self):
+		''' a timer firing late means callbacks are queued behind slow work '''
+		now = self.loop.time()
+		self.lag      = max(now - self.expected, 0.0)
+		self.expected = now + self.lag_interval
+		self.handle   = self.loop.call_later(self.lag_interval, self.tick)
+		self.update()
+
+	##### Limits #####
+
+	def admit_connection(self, clients):
+		''' check a new connection against max_connections '''
+		if self.max_connections is not None and len(clients) >= self.max_connections:
+			self.rejected_connections += 1
+			return False
+		return True
+
+	def enter(self):
+		''' count a request in, False when it should be shed '''
+		if self.max_inflight is not None and self.inflight >= self.max_inflight:
+			self.rejected_requests += 1
+			return False
+		self.inflight += 1
+		if self.pause_queue_depth is not None:
+			self.update()
+		return True
+
+	def leave(self):
+		self.inflight -= 1
+		if self.pause_queue_depth is not None:
+			self.update()
+
+	def update(self):
+		''' pause or resume accepting, resuming only well below the thresholds '''
+		if self.accepting is None:
+			return
+		depth, lag = self.pause_queue_depth, self.pause_loop_lag
+		if not self.paused:
+			if (depth is not None and self.inflight >= depth) or \
+				(lag is not None and self.lag > lag):
+				self.paused = True
+				self.accepting.clear()
+		else:
+			if (depth is None or self.inflight < depth * 3 // 4) and \
+				(lag is None or self.lag <= lag / 2):
+				self.paused = False
+				self.accepting.set()
+
+	@property
+	def headers(self):
+		return {'Retry-After': self.retry_after}
+
+	def rejection(self):
+		''' the 503 written to connections over the limit '''
+		return createResponse(ApricotResponse(status=503, headers=self.headers), False)
+
+	async def shed(self, reader, writer):
+		''' answer a stream connection over the limit and drop what it sends '''
+		writer.write(self.rejection())
+		if writer.can_write_eof():
+			writer.write_eof()
+		try:
+			await asyncio.wait_for(self.discard(reader), self.linger)
+		except (asyncio.TimeoutError, ConnectionError):
+			pass
+		writer.close()
+
+	async def discard(self, reader):
+		while await reader.read(64 * 1024):
+			pass
+
+
+class ApricotAcceptor(object):
+	''' Accept loop over a listening socket that waits while admission is paused
+
+	Stands in for the asyncio server object, close() and wait_closed() work
+	the same way.
+	'''
+
+	def __init__(self, server, sock):
+		self.server = server
+		self.sock   = sock
+		self.task   = server.loop.create_task(self.run())
+
+	async def run(self):
+		loop      = self.server.loop
+		accepting = self.server.admission.accepting
+		while True:
+			if not accepting.is_set():
+				await accepting.wait()
+
+			try:
+				conn, _ = await loop.sock_accept(self.sock)
+			except OSError:
+				# out of file descriptors, let connections finish first
+				await asyncio.sleep(0.1)
+				continue
+
+			if conn.family != getattr(socket, 'AF_UNIX', None):
+				conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			try:
+				await loop.connect_accepted_socket(self.server.make_protocol, conn)
+			except OSError:
+				conn.close()
+
+	def close(self):
+		self.task.cancel()
+		self.sock.close()
+
+	async def wait_closed(self):
+		try:
+			await self.task
+		except asyncio.CancelledError:
+			pass
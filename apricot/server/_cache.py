@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#! python3
+
+import time
+import hashlib
+from collections import OrderedDict
+from ..client import ApricotResponse
+from ..utils import createHead, createHeaderLines, getHeader, ApricotHeaders
+
+class ApricotCacheEntry(object):
+	''' A cached response, its header lines and body already encoded '''
+
+	# rough per entry overhead counted against the memory budget
+	overhead = 256
+
+	def __init__(self, response, expires, vary=()):
+		self.expires = expires
+		self.status  = response.status
+		self.body    = response.payload or b''
+
+		headers = ApricotHeaders(response.headers)
+		if vary:
+			names = [name.strip() for name in (headers.get('Vary') or '').split(',') if name.strip()]
+			headers['Vary'] = ', '.join(names + [name for name in vary if name not in names])
+
+		etag = getHeader(headers, 'ETag')
+		if etag is None:
+			etag = '"%s"' % hashlib.blake2b(self.body, digest_size=8).hexdigest()
+			headers['ETag'] = etag
+		self.etag    = etag
+		self.headers = headers
+		self.lines   = createHeaderLines(headers)
+
+		# 304s repeat the validator and the caching headers only
+		kept = {'ETag': etag}
+		for name in ('Cache-Control', 'Vary', 'Expires', 'Last-Modified'):
+			value = getHeader(headers, name)
+			if value is not None: kept[name] = value
+		self.not_modified_headers = kept
+		self.not_modified_lines   = createHeaderLines(kept)
+
+		self.size = len(self.lines) + len(self.body) + self.overhead
+
+	def matches(self, request):
+		''' check If-None-Match against the entry ETag '''
+		match = getHeader(request.headers, 'If-None-Match')
+		if match is None:
+			return False
+		tags = [tag.strip() for tag in match.split(',')]
+		return '*' in tags or self.etag in tags or ('W/' + self.etag) in tags
+
+	def changed(self, headers):
+		''' check if a middleware changed the headers of a hit '''
+		return headers is not None and headers.names != self.headers.names
+
+	def head(self, keep_alive, headers=None, status=None):
+		''' the encoded header block, or the headers a hit ended up with '''
+		status = self.status if status is None else status
+		if not self.changed(headers):
+			return createHead(status, self.headers, keep_alive, self.lines)
+		return createHead(status, headers, keep_alive)
+
+	def not_modified(self, keep_alive, headers=None):
+		''' the 304 header block, headers middlewares added or changed included '''
+		if not self.changed(headers):
+			return createHead(304, self.not_modified_headers, keep_alive, self.not_modified_lines)
+		kept = ApricotHeaders(self.not_modified_headers)
+		for key, entry in headers.names.items():
+			if self.headers.names.get(key) != entry:
+				kept.names[key] = list(entry)
+		return createHead(304, kept, keep_alive)
+
+
+class ApricotCachedResponse(ApricotResponse):
+	''' A cached response passed back through the middlewares, the client
+	writes the serialized entry with the headers the middlewares left
+	'''
+
+	__slots__ = ('entry',)
+
+	def __init__(self, entry):
+		super().__init__(status=entry.status, headers=entry.headers)
+		self.entry = entry
+		self.using = 'cached'
+
+
+class ApricotResponseCache(object):
+	''' LRU of serialized GET responses shared by the routes of a router
+
+	Routes opt in with cache=<ttl seconds> and list the request headers the
+	response depends on with vary=[...]. Entries are dropped once expired
+	or when the cache grows over max_bytes, least recently used first.
+	The innermost layer of the route middleware chain stores the handler
+	response and answers hits, so every middleware still sees the request
+	and the response, and headers they set are never stored.
+	'''
+
+	def __init__(self, max_bytes=64 * 1024 * 1024):
+		self.max_bytes = max_bytes
+		self.entries   = OrderedDict() # key -> ApricotCacheEntry
+		self.size      = 0
+		self.hits      = 0
+		self.misses    = 0
+
+	def key(self, request, route, coding=None):
+		''' (method, path with query, vary header values, content coding) '''
+		return (request.method, request.path,
+			tuple(getHeader(request.headers, name) for name in route.vary), coding)
+
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is not None:
+			if entry.expires > time.monotonic():
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry
+			self.remove(key)
+		self.misses += 1
+		return None
+
+	def cacheable(self, response):
+		''' only complete, public 200 responses are kept '''
+		if response.status != 200 or response.using not in ('body', 'text'):
+			return False
+		if getHeader(response.headers, 'Set-Cookie') is not None:
+			return False
+		control = (getHeader(response.headers, 'Cache-Control') or '').lower()
+		return 'no-store' not in control and 'private' not in control
+
+	def store(self, key, response, route):
+		''' keep a response for route.cache seconds, returns the entry or None '''
+		if not self.cacheable(response):
+			return None
+		entry = ApricotCacheEntry(response, time.monotonic() + route.cache, route.vary)
+		if entry.size > self.max_bytes:
+			return None
+
+		self.remove(key)
+		self.entries[key] = entry
+		self.size += entry.size
+		while self.size > self.max_bytes:
+			self.size -= self.entries.popitem(last=False)[1].size
+		return entry
+
+	def remove(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self.size -= entry.size
+
+	def clear(self):
+		self.entries.clear()
+		self.size = 0
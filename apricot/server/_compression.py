@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#! python3
+
+import copy
+import zlib
+import hashlib
+from collections import OrderedDict
+from ..utils import getHeader, ApricotHeaders
+
+# zlib window bits per content coding
+ENCODINGS = {
+	"gzip"   : 31,
+	"deflate": 15
+}
+
+# content types that are already compressed
+COMPRESSED_TYPES = (
+	"image/", "video/", "audio/", "font/woff",
+	"application/zip", "application/gzip", "application/x-gzip",
+	"application/x-bzip2", "application/x-7z-compressed",
+	"application/x-rar-compressed", "application/pdf"
+)
+
+def parseQualities(header):
+	''' {coding: q} of an Accept-Encoding value, a q of 0 refuses the coding '''
+	qvalues = {}
+	for item in header.split(','):
+		coding, *params = item.split(';')
+		coding = coding.strip().lower()
+		if not coding:
+			continue
+		q = 1.0
+		for param in params:
+			name, _, value = param.strip().partition('=')
+			if name.strip().lower() == 'q':
+				try:
+					q = float(value.strip())
+				except ValueError:
+					q = 0.0
+				if not 0.0 <= q <= 1.0: q = 0.0
+		qvalues[coding] = q
+	return qvalues
+
+def addVary(headers, name):
+	''' add a request header name to Vary, keeping the names already there '''
+	names = [item.strip() for item in (headers.get('Vary') or '').split(',') if item.strip()]
+	if '*' not in names and name.lower() not in [item.lower() for item in names]:
+		names.append(name)
+	headers['Vary'] = ', '.join(names)
+
+class ApricotCompression(object):
+	''' gzip/deflate response compression
+
+	The coding is negotiated from Accept-Encoding. Small bodies and types
+	that are already compressed are sent as they are, streamed responses
+	are compressed chunk by chunk. Compressed bodies are kept in an LRU
+	keyed by a hash of the content, so hot responses are compressed once.
+	'''
+
+	def __init__(self, min_size=1024, level=6,
+		cache_size=256, cache_bytes=16 * 1024 * 1024):
+		self.min_size    = min_size
+		self.level       = level
+		self.cache_size  = cache_size
+		self.cache_bytes = cache_bytes
+		self.cache       = OrderedDict() # (coding, digest) -> bytes
+		self.cached      = 0
+
+	def negotiate(self, request):
+		''' pick a coding from Accept-Encoding, or None '''
+		header = getHeader(request.headers, 'Accept-Encoding')
+		if not header:
+			return None
+
+		# q-values named explicitly, '*' covers the codings not named
+		qvalues = parseQualities(header)
+		star    = qvalues.pop('*', None)
+
+		best, best_q = None, 0.0
+		for coding in ENCODINGS: # gzip first, it wins ties
+			q = qvalues.get(coding, star)
+			if q is not None and q > best_q:
+				best, best_q = coding, q
+		return best
+
+	def compressible(self, response):
+		''' check if a response may be compressed at all '''
+		if response.using == 'file':
+			return False
+		if response.status < 200 or response.status in (204, 206, 304):
+			return False
+		if getHeader(response.headers, 'Content-Encoding') is not None:
+			return False
+		content_type = (response.content_type or '').lower()
+		if content_type.startswith(COMPRESSED_TYPES) and 'svg' not in content_type:
+			return False
+		if response.using == 'stream':
+			return True
+		return response.payload is not None and len(response.payload) >= self.min_size
+
+	def apply(self, request, response):
+		''' return a compressed copy of the response when it is worth it '''
+		if not self.compressible(response):
+			return response
+
+		# sent as it is or not, the body depends on Accept-Encoding
+		original = response
+		response = copy.copy(response)
+		response.headers = ApricotHeaders(response.headers)
+		addVary(response.headers, 'Accept-Encoding')
+		coding = self.negotiate(request)
+		if coding is None:
+			return response
+		response.headers['Content-Encoding'] = coding
+
+		if response.using == 'stream':
+			response.body = self.compress_stream(original, coding)
+			return response
+
+		response.payload = self.compress(response.payload, coding)
+		response.headers['Content-Length'] = len(response.payload)
+		return response
+
+	def compress(self, data, coding):
+		''' compress a body, reusing earlier results for the same content '''
+		key  = (coding, hashlib.blake2b(data, digest_size=16).digest())
+		body = self.cache.get(key)
+		if body is not None:
+			self.cache.move_to_end(key)
+			return body
+
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODINGS[coding])
+		body = compressor.compress(data) + compressor.flush()
+
+		# keep within the entry and byte budgets
+		if len(body) <= self.cache_bytes:
+			self.cache[key] = body
+			self.cached += len(body)
+			while len(self.cache) > self.cache_size or self.cached > self.cache_bytes:
+				self.cached -= len(self.cache.popitem(last=False)[1])
+		return body
+
+	async def compress_stream(self, response, coding):
+		''' compress an async iterable of bytes as it is produced '''
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODINGS[coding])
+		async for chunk in response.iterate():
+			data = compressor.compress(chunk)
+			if data:
+				yield data
+		data = compressor.flush()
+		if data:
+			yield data
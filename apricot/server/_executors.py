@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#! python3
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from ..client import ApricotResponse
+from ..utils import ApricotHeaders
+
+class ApricotWorkerRequest(object):
+	''' The parts of a request a process pool handler gets
+
+	Pickled as one tuple of plain values, the connection, parser and body
+	stream stay in the server process.
+	'''
+
+	__slots__ = ('method', 'path', 'version', 'headers', 'query_dict',
+		'match_info', 'body', 'charset')
+
+	def __init__(self, method, path, version, headers, query_dict,
+		match_info, body, charset):
+		self.method     = method
+		self.path       = path
+		self.version    = version
+		self.headers    = headers
+		self.query_dict = query_dict
+		self.match_info = match_info
+		self.body       = body
+		self.charset    = charset
+
+	@classmethod
+	def from_request(cls, request):
+		path = request.path
+		if isinstance(path, bytes): path = path.decode('utf-8')
+		return cls(request.method, path, request.version, ApricotHeaders(request.headers),
+			dict(request.query_dict), dict(request.match_info), request.body,
+			request.charset)
+
+	def __reduce__(self):
+		return (ApricotWorkerRequest, tuple(getattr(self, name) for name in self.__slots__))
+
+	@property
+	def text(self):
+		if self.body is None:
+			return ''
+		return self.body.decode(self.charset or 'utf-8')
+
+def runInProcess(func, request):
+	''' call a handler in a pool process, the response goes back as a tuple '''
+	response = func(request)
+	if not isinstance(response, ApricotResponse) or response.using not in ('body', 'text'):
+		raise TypeError("process pool handlers must return an ApricotResponse with a body")
+	return response.status, response.headers, response.content_type, response.payload
+
+
+class ApricotExecutors(object):
+	''' Bounded thread and process pools for handlers that block
+
+	Routes added with executor="thread" or executor="process" take a plain
+	function (request) -> ApricotResponse. Thread handlers get the request
+	itself, process handlers an ApricotWorkerRequest. With max_queue set,
+	calls over that many waiting for a worker get a 503 instead of queueing.
+	'''
+
+	KINDS = ("thread", "process")
+
+	def __init__(self, threads=None, processes=None, max_queue=None, retry_after=1):
+		self.workers     = {"thread": threads, "process": processes}
+		self.max_queue   = max_queue
+		self.retry_after = retry_after
+		self.pools       = {}
+		self.pending     = dict.fromkeys(self.KINDS, 0) # submitted, not finished
+		self.rejected    = dict.fromkeys(self.KINDS, 0)
+
+	def pool(self, kind):
+		''' get a pool, created on first use '''
+		pool = self.pools.get(kind)
+		if pool is None:
+			if kind == "thread":
+				pool = ThreadPoolExecutor(self.workers[kind], thread_name_prefix="apricot")
+			else:
+				pool = ProcessPoolExecutor(self.workers[kind])
+			self.pools[kind] = pool
+			self.workers[kind] = pool._max_workers
+		return pool
+
+	def queued(self, kind):
+		''' calls waiting for a free worker '''
+		return max(self.pending[kind] - (self.workers[kind] or 0), 0)
+
+	def wrap(self, kind, func):
+		''' a coroutine handler running func in the pool of kind '''
+		if kind not in self.KINDS:
+			raise ValueError("Unknown executor %r" % (kind,))
+
+		async def handler(request):
+			return await self.run(kind, func, request)
+		handler.__name__ = getattr(func, '__name__', 'handler')
+		return handler
+
+	async def run(self, kind, func, request):
+		pool = self.pool(kind)
+		if self.max_queue is not None and self.queued(kind) >= self.max_queue:
+			self.rejected[kind] += 1
+			return ApricotResponse(status=503, headers={'Retry-After': self.retry_after})
+
+		loop = asyncio.get_event_loop()
+		self.pending[kind] += 1
+		try:
+			if kind == "thread":
+				return await loop.run_in_executor(pool, func, request)
+			status, headers, content_type, payload = await loop.run_in_executor(
+				pool, runInProcess, func, ApricotWorkerRequest.from_request(request))
+			return ApricotResponse(status=status, headers=headers,
+				content_type=content_type, body=payload)
+		finally:
+			self.pending[kind] -= 1
+
+	def shutdown(self):
+		for pool in self.pools.values():
+			pool.shutdown(wait=False)
+		self.pools.clear()
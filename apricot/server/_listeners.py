@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#! python3
+
+import os
+import stat
+import socket
+
+class ApricotListenerError(Exception): pass
+
+class ApricotListener(object):
+	''' An address ApricotServer accepts connections on
+
+	A TCP host and port, a Unix domain socket path or a socket that is
+	already listening, passed as a socket object or a file descriptor.
+	bind() returns the listening socket, every kind is served the same way.
+	'''
+
+	# first file descriptor passed by systemd socket activation
+	SD_LISTEN_FDS_START = 3
+
+	def __init__(self, kind, address=None, sock=None, mode=None, backlog=128):
+		self.kind    = kind    # 'tcp', 'unix' or 'socket'
+		self.address = address # (host, port) or a path
+		self.mode    = mode    # permissions of a Unix socket file
+		self.backlog = backlog
+		self.sock    = sock
+		self.owner   = None    # pid that created the Unix socket file
+
+	@classmethod
+	def tcp(cls, host="localhost", port=8080, backlog=128):
+		return cls('tcp', (host, port), backlog=backlog)
+
+	@classmethod
+	def unix(cls, path, mode=None, backlog=128):
+		''' listen on a Unix domain socket
+		@param mode : permissions of the socket file, 0o660 to limit it to a group
+		'''
+		if not hasattr(socket, 'AF_UNIX'):
+			raise ApricotListenerError("Unix domain sockets are not supported here")
+		return cls('unix', os.fspath(path), mode=mode, backlog=backlog)
+
+	@classmethod
+	def inherit(cls, sock):
+		''' listen on an open socket or file descriptor, it must already listen '''
+		if isinstance(sock, int):
+			sock = socket.socket(fileno=sock)
+		if sock.type != socket.SOCK_STREAM:
+			raise ApricotListenerError("Listening sockets must be SOCK_STREAM")
+		return cls('socket', sock.getsockname(), sock=sock)
+
+	@classmethod
+	def systemd(cls):
+		''' listeners for the sockets passed by systemd socket activation '''
+		if os.environ.get('LISTEN_PID') != str(os.getpid()):
+			return []
+		count = int(os.environ.get('LISTEN_FDS', 0))
+		for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+			os.environ.pop(name, None)
+		return [cls.inherit(cls.SD_LISTEN_FDS_START + pos) for pos in range(count)]
+
+	@classmethod
+	def create(cls, spec):
+		''' a listener from an ApricotListener, (host, port), a Unix socket
+		path, a socket or a file descriptor
+		'''
+		if isinstance(spec, ApricotListener):
+			return spec
+		if isinstance(spec, tuple):
+			return cls.tcp(*spec)
+		if isinstance(spec, (str, bytes, os.PathLike)):
+			return cls.unix(spec)
+		if isinstance(spec, (int, socket.socket)):
+			return cls.inherit(spec)
+		raise ApricotListenerError("Unknown listener %r" % (spec,))
+
+	@property
+	def shared(self):
+		''' bound once and inherited by forked workers, TCP workers bind their own '''
+		return self.kind != 'tcp'
+
+	def bind(self):
+		''' the non-blocking listening socket, created on first call '''
+		if self.sock is None:
+			if self.kind == 'tcp':
+				self.sock = socket.create_server(self.address, family=socket.AF_INET,
+					backlog=self.backlog, reuse_port=True)
+			elif self.kind == 'unix':
+				self.sock = self.bind_unix()
+			else:
+				raise ApricotListenerError("Inherited socket %s is closed" % (self,))
+		self.sock.setblocking(False)
+		return self.sock
+
+	def bind_unix(self):
+		path = self.address
+
+		# a socket file left behind by an earlier run
+		try:
+			if stat.S_ISSOCK(os.stat(path).st_mode):
+				os.unlink(path)
+		except FileNotFoundError:
+			pass
+
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.bind(path)
+			if self.mode is not None:
+				os.chmod(path, self.mode)
+			sock.listen(self.backlog)
+		except OSError:
+			sock.close()
+			raise
+		self.owner = os.getpid()
+		return sock
+
+	def close(self):
+		''' close the socket and remove the Unix socket file this process made '''
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+		if self.kind == 'unix' and self.owner == os.getpid():
+			try:
+				os.unlink(self.address)
+			except OSError:
+				pass
+			self.owner = None
+
+	def __str__(self):
+		if self.kind == 'unix':
+			return 'unix:' + self.address
+		if isinstance(self.address, tuple):
+			return '{0}:{1}'.format(*self.address[:2])
+		return str(self.address)
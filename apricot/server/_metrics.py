@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#! python3
+
+from bisect import bisect_left
+from ..client import ApricotResponse
+
+# request phases with a latency histogram
+PHASES = ("header", "parse", "route", "handler", "serialize", "write")
+
+# histogram upper bounds in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+	0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class ApricotHistogram(object):
+	''' Fixed bucket histogram, one list increment per observation '''
+
+	def __init__(self, buckets=BUCKETS):
+		self.bounds = tuple(buckets)
+		self.counts = [0] * (len(self.bounds) + 1) # last one is +Inf
+		self.sum    = 0.0
+		self.count  = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.sum   += value
+		self.count += 1
+
+	def cumulative(self):
+		''' [(upper bound, observations <= bound)], ending with +Inf '''
+		result, total = [], 0
+		for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+			total += count
+			result.append((bound, total))
+		return result
+
+	def reset(self):
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.sum    = 0.0
+		self.count  = 0
+
+
+class ApricotMetrics(object):
+	''' Request counters, phase latency histograms, gauges and byte counts
+
+	Counters are plain dict and list increments made by the connections.
+	snapshot() returns them as a dict, render() in the Prometheus text format.
+	'''
+
+	def __init__(self, buckets=BUCKETS):
+		self.buckets   = buckets
+		self.requests  = {} # (method, route, status) -> count
+		self.phases    = {phase: ApricotHistogram(buckets) for phase in PHASES}
+		self.gauges    = {} # name -> (help, callable)
+		self.bytes_in  = 0
+		self.bytes_out = 0
+
+	def add_gauge(self, name, description, func):
+		''' report func() as a gauge '''
+		self.gauges[name] = (description, func)
+
+	##### Recording #####
+
+	def count(self, request, status):
+		''' count a response under its route pattern and status code '''
+		route = request.route.path if request.route is not None else 'none'
+		key   = (request.method, route, status)
+		self.requests[key] = self.requests.get(key, 0) + 1
+
+	def record(self, request, status):
+		''' count a finished request and observe the phases it went through '''
+		self.count(request, status)
+		for phase, elapsed in request.phases.items():
+			self.phases[phase].observe(elapsed)
+
+	def reset(self):
+		self.requests.clear()
+		for histogram in self.phases.values():
+			histogram.reset()
+		self.bytes_in  = 0
+		self.bytes_out = 0
+
+	##### Reporting #####
+
+	def snapshot(self):
+		''' current values as plain python types '''
+		return {
+			"requests" : [{"method": method, "route": route, "status": status, "count": count}
+				for (method, route, status), count in self.requests.items()],
+			"phases"   : {phase: {
+					"count"  : histogram.count,
+					"sum"    : histogram.sum,
+					"buckets": histogram.cumulative()
+				} for phase, histogram in self.phases.items()},
+			"gauges"   : {name: func() for name, (_, func) in self.gauges.items()},
+			"bytes_in" : self.bytes_in,
+			"bytes_out": self.bytes_out
+		}
+
+	def render(self):
+		''' Prometheus text exposition format '''
+		lines = [
+			'# HELP apricot_requests_total Responses by method, route and status',
+			'# TYPE apricot_requests_total counter'
+		]
+		for (method, route, status), count in sorted(self.requests.items(), key=str):
+			lines.append('apricot_requests_total{method="%s",route="%s",status="%d"} %d' % (
+				escape(method), escape(route), status, count))
+
+		lines.append('# HELP apricot_phase_seconds Request phase latency')
+		lines.append('# TYPE apricot_phase_seconds histogram')
+		for phase, histogram in self.phases.items():
+			for bound, total in histogram.cumulative():
+				le = '+Inf' if bound == float('inf') else repr(bound)
+				lines.append('apricot_phase_seconds_bucket{phase="%s",le="%s"} %d' % (phase, le, total))
+			lines.append('apricot_phase_seconds_sum{phase="%s"} %r' % (phase, histogram.sum))
+			lines.append('apricot_phase_seconds_count{phase="%s"} %d' % (phase, histogram.count))
+
+		for name, description, value in (
+			("apricot_received_bytes_total", "Bytes received", self.bytes_in),
+			("apricot_sent_bytes_total", "Bytes sent", self.bytes_out)):
+			lines.append('# HELP %s %s' % (name, description))
+			lines.append('# TYPE %s counter' % name)
+			lines.append('%s %d' % (name, value))
+
+		for name, (description, func) in self.gauges.items():
+			lines.append('# HELP %s %s' % (name, description))
+			lines.append('# TYPE %s gauge' % name)
+			lines.append('%s %s' % (name, func()))
+		return '\n'.join(lines) + '\n'
+
+	async def handler(self, request):
+		''' route handler serving render() '''
+		return ApricotResponse(status=200, text=self.render(),
+			content_type='text/plain; version=0.0.4')
+
+def escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#! python3
+
+from time import perf_counter
+
+class ApricotTimings(object):
+	''' Aggregated time spent per route and layer
+
+	Every middleware and handler call adds its own time, the time of the
+	layers it wraps excluded, under (route path, layer name).
+	'''
+
+	def __init__(self):
+		self.stats = {} # (route, layer) -> [count, total, max]
+
+	def add(self, key, elapsed):
+		stat = self.stats.get(key)
+		if stat is None:
+			self.stats[key] = [1, elapsed, elapsed]
+			return
+		stat[0] += 1
+		stat[1] += elapsed
+		if elapsed > stat[2]: stat[2] = elapsed
+
+	def snapshot(self):
+		''' {route: {layer: {count, total, mean, max}}} in seconds '''
+		result = {}
+		for (route, layer), (count, total, peak) in self.stats.items():
+			result.setdefault(route, {})[layer] = {
+				"count": count,
+				"total": total,
+				"mean" : total / count,
+				"max"  : peak
+			}
+		return result
+
+	def reset(self):
+		self.stats.clear()
+
+def layerName(func):
+	func = getattr(func, 'func', func) # functools.partial
+	return getattr(func, '__name__', type(func).__name__)
+
+def compose(middlewares, handler, route='*', timings=None):
+	''' chain middlewares around a handler once, outermost first
+
+	A middleware is a coroutine function (request, handler) -> response.
+	'''
+	chain = timeLayer(handler, None, route, timings)
+	for middleware in reversed(middlewares):
+		chain = timeLayer(middleware, chain, route, timings)
+	return chain
+
+def timeLayer(func, inner, route, timings):
+	''' wrap one layer so its own time lands in request.timings and timings '''
+	key  = (route, layerName(func))
+	name = key[1]
+
+	if inner is None:
+		async def layer(request):
+			request.inner_time = 0.0
+			start = perf_counter()
+			try:
+				return await func(request)
+			finally:
+				elapsed = perf_counter() - start
+				request.inner_time = elapsed
+				request.timings[name] = elapsed
+				if timings is not None: timings.add(key, elapsed)
+	else:
+		async def layer(request):
+			request.inner_time = 0.0
+			start = perf_counter()
+			try:
+				return await func(request, inner)
+			finally:
+				elapsed = perf_counter() - start
+				own = elapsed - request.inner_time
+				request.inner_time = elapsed
+				request.timings[name] = own
+				if timings is not None: timings.add(key, own)
+	return layer
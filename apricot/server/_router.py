@@ -1,68 +1,181 @@
 #!/usr/bin/env python3
 #! python3
 
+import copy
 import asyncio
+from functools import partial
 from ..client import ApricotRequest
 from ..client import ApricotResponse
+from ..client import ApricotBodyTooLarge
+from ..utils import getHeader, ApricotHeaders
+from ._tree import ApricotRouteTree
+from ._static import ApricotStatic
+from ._middleware import ApricotTimings, compose
+from ._cache import ApricotResponseCache, ApricotCachedResponse
 
 class ApricotInvalidHttpMethod(Exception): pass
 
+METHODS = ("GET", "POST", "HEAD", "PUT", "PATCH", "DELETE", "OPTIONS")
+
+class ApricotRoute(object):
+	''' A registered handler and its options '''
+
+	def __init__(self, method, path, callback, stream=False, middlewares=None,
+		cache=None, vary=(), coalesce=False, executor=None):
+		self.method      = method
+		self.path        = path
+		self.callback    = callback
+		self.stream      = stream
+		self.middlewares = list(middlewares or [])
+		self.cache       = cache # seconds responses are cached for
+		self.vary        = tuple(vary)
+		self.coalesce    = coalesce # True or a function request -> key
+		self.executor    = executor # None, 'thread' or 'process'
+		self.handler     = callback # callback wrapped in its middleware chain
+
 class ApricotRouter(object):
 	''' Apricot Router to route http requests '''
 
 	def __init__(self, server):
 		self.server = server
-		self.routes = {
-			"GET":[],
-			"POST":[],
-			"HEAD":[]
-		}
+		self.tree   = ApricotRouteTree()
+		self.routes = {method: [] for method in METHODS}
+
+		# middleware chains are composed when routes are added
+		self.middlewares = []
+		self.timings     = ApricotTimings()
+		self.all_routes  = []
+		self.not_found   = None
+		self.not_allowed = {} # allowed methods -> composed 405 chain
+		self.compose_defaults()
+
+		# responses of routes added with cache=<ttl>
+		self.cache = ApricotResponseCache()
+
+		# handler calls shared by routes added with coalesce=True
+		self.flights   = {} # key -> future of the response
+		self.coalesced = 0  # requests answered by another request's call
+
+	##### Middleware #####
+
+	def add_middleware(self, middleware):
+		''' add a global middleware, coroutine (request, handler) -> response '''
+		self.middlewares.append(middleware)
+
+		# rebuild the chains so the new layer applies everywhere
+		for route in self.all_routes:
+			self.compose_route(route)
+		self.compose_defaults()
+
+	def compose_route(self, route):
+		callback = route.callback
+		if route.executor is not None:
+			callback = self.server.executors.wrap(route.executor, callback)
+		layers = self.middlewares + route.middlewares
+		if route.cache:
+			layers = layers + [self.cached]
+		if route.coalesce:
+			layers = layers + [self.coalesce]
+		route.handler = compose(layers, callback,
+			route.method + ' ' + route.path, self.timings)
+
+	def compose_defaults(self):
+		self.not_found = compose(self.middlewares, self.default_404, '404', self.timings)
+		self.not_allowed.clear()
+
+	def compose_405(self, handlers):
+		''' the 405 chain for a set of allowed methods, composed once '''
+		allowed = frozenset(handlers)
+		chain   = self.not_allowed.get(allowed)
+		if chain is None:
+			chain = self.not_allowed[allowed] = compose(self.middlewares,
+				partial(self.default_405, allowed=allowed), '405', self.timings)
+		return chain
 
 	##### Routing #####
 
-	def add_get(self, path='/', callback=None):
-		self.add_route('GET', path, callback)
+	def add_get(self, path='/', callback=None, **options):
+		return self.add_route('GET', path, callback, **options)
+
+	def add_post(self, path='/', callback=None, **options):
+		return self.add_route('POST', path, callback, **options)
 
-	def add_post(self, path='/', callback=None):
-		self.add_route('POST', path, callback)
+	def add_head(self, path='/', callback=None, **options):
+		return self.add_route('HEAD', path, callback, **options)
 
-	def add_head(self, path='/', callback=None):
-		self.add_route('HEAD', path, callback)
+	def add_put(self, path='/', callback=None, **options):
+		return self.add_route('PUT', path, callback, **options)
 
-	def add_route(self, method, path='/', callback=None):
-		''' add a coroutine object to callback of route '''
-		if str(method).upper() not in self.routes:
+	def add_patch(self, path='/', callback=None, **options):
+		return self.add_route('PATCH', path, callback, **options)
+
+	def add_delete(self, path='/', callback=None, **options):
+		return self.add_route('DELETE', path, callback, **options)
+
+	def add_options(self, path='/', callback=None, **options):
+		return self.add_route('OPTIONS', path, callback, **options)
+
+	def add_route(self, method, path='/', callback=None, **options):
+		''' add a coroutine object to callback of route
+		@param path : may hold parameters, /users/{id:int} or /files/{name:path}
+		@param stream : hand the body to the handler unread, see request.stream()
+		@param middlewares : middlewares for this route, inside the global ones
+		@param cache : seconds GET responses are kept in router.cache, hits pass
+			the middlewares but skip the handler and the serializer
+		@param vary : request headers cached responses depend on
+		@param coalesce : share one handler call between identical concurrent
+			GET requests, True keys on method, path, query and vary headers,
+			a function request -> key keys on anything else
+		@param executor : 'thread' or 'process' to run a plain, blocking
+			function in a pool of server.executors
+		'''
+		method = str(method).upper()
+		if method not in self.routes:
 			raise ApricotInvalidHttpMethod("Method is not valid!")
 
 		# add/override route
+		route = ApricotRoute(method, path, callback, **options)
+		self.compose_route(route)
+		self.all_routes.append(route)
+		self.tree.add(path, method, route)
 		entry = [path, callback]
-		self.routes[str(method).upper()].append(entry)
+		self.routes[method].append(entry)
+		return route
 
-	##### Request Processing ####
+	def add_static(self, prefix, directory, **kwargs):
+		''' serve the files of a directory below a url prefix '''
+		handler = ApricotStatic(directory, **kwargs)
+		self.add_get(prefix.rstrip('/') + '/{filename:path}', handler)
+		return handler
 
-	async def default_404(self, request):
-		''' do default 404 not found messages '''
-		return ApricotResponse(status=404)
+	def add_metrics(self, path='/metrics'):
+		''' expose the server metrics in the Prometheus text format '''
+		metrics = self.server.enable_metrics()
+		self.add_get(path, metrics.handler)
+		return metrics
 
-	async def default_200(self, request):
-		''' do default 200 ok message for post '''
-		return ApricotResponse(status=200)
+	def resolve(self, method, path):
+		''' find (route, path params, allowed methods) for a request '''
+		handlers, params = self.tree.find(path)
+		if handlers is None:
+			return None, None, None
 
-	async def perform_task(self, func, client, request):
-		''' perform an async task '''
-		response = await func(request)
-		client.response = response
+		route = handlers.get(method)
 
-	##### Main Request processsing #####
+		# HEAD falls back to GET, the body is dropped on write
+		if route is None and method == 'HEAD':
+			route = handlers.get('GET')
+		return route, params, handlers
 
-	async def process_request(self, client, request):
-		''' route request to coroutine path '''
+	def route_request(self, request):
+		''' find the coroutine for a request, sets request.route and match_info '''
+		if request.handler is not None:
+			return request.handler
 
 		# setup vars for evaluation
 		path   = request.path
 		if isinstance(path, bytes): path = path.decode('utf-8')
 		method = request.method
-		found  = False
 		coro   = None
 
 		try:
@@ -70,26 +183,146 @@ class ApricotRouter(object):
 			if '?' in path: path = path.split('?')[0]
 
 			# find coroutine to run
-			if method.upper() in self.routes:
-				routes = self.routes[method.upper()]
-				for route in routes:
-					if route[0] == path:
-						found = True
-						coro  = route[1]
-						break
+			route, params, handlers = self.resolve(method.upper(), path)
+			if route is not None:
+				request.route      = route
+				request.match_info = params
+				coro = route.handler
+			elif handlers is not None:
+				coro = self.compose_405(handlers)
 		except:
 			pass
 
 		# set default coro if coro wasn't found
-		if not found:
-			coro = self.default_404
+		if coro is None:
+			coro = self.not_found
 
-		# done callback
-		def on_finish(self, *args):
-			client.event.set() # set client for response object
+		request.handler = coro
+		return coro
 
-		# run task and add callback
-		task_coro = lambda: self.perform_task(coro, client, request) 
-		new_task  = asyncio.Task(task_coro())
-		new_task.add_done_callback(on_finish)
+	##### Request Processing ####
 
+	async def default_404(self, request):
+		''' do default 404 not found messages '''
+		return ApricotResponse(status=404)
+
+	async def default_405(self, request, allowed=()):
+		''' do default 405 method not allowed messages '''
+		allow = set(allowed)
+		if 'GET' in allow: allow.add('HEAD')
+		allow = ', '.join(method for method in METHODS if method in allow)
+		return ApricotResponse(status=405, headers={'Allow': allow})
+
+	async def default_200(self, request):
+		''' do default 200 ok message for post '''
+		return ApricotResponse(status=200)
+
+	async def default_500(self, request, exc):
+		''' report a handler exception to the loop and answer 500 '''
+		self.report(request, exc)
+		return ApricotResponse(status=500)
+
+	def report(self, request, exc, message='Unhandled exception in handler for'):
+		''' pass an exception to the loop exception handler with its request '''
+		path = request.path
+		if isinstance(path, bytes): path = path.decode('utf-8', 'replace')
+		asyncio.get_event_loop().call_exception_handler({
+			'message'  : '%s %s %s' % (message, request.method, path),
+			'exception': exc,
+			'request'  : request
+		})
+
+	##### Response cache #####
+
+	def cache_key(self, request):
+		''' key of a request in the response cache, None when not cached '''
+		route = request.route
+		if route is None or not route.cache or request.method not in ('GET', 'HEAD'):
+			return None
+		coding = None
+		if self.server.compression is not None:
+			coding = self.server.compression.negotiate(request)
+		return self.cache.key(request, route, coding)
+
+	async def cached(self, request, handler):
+		''' innermost layer of cached routes, answers hits without the handler
+		and stores the handler response before the middlewares change it
+		'''
+		key = self.cache_key(request)
+		if key is None:
+			return await handler(request)
+		entry = self.cache.get(key)
+		if entry is not None:
+			return ApricotCachedResponse(entry)
+
+		response = await handler(request)
+		if not isinstance(response, ApricotResponse):
+			return response
+
+		# the entry holds the body in the negotiated coding
+		if self.server.compression is not None:
+			response = self.server.compression.apply(request, response)
+		entry = self.cache.store(key, response, request.route)
+		if entry is None:
+			return response
+		return ApricotCachedResponse(entry)
+
+	##### Main Request processsing #####
+
+	async def process_request(self, request):
+		''' await the handler of a request and return its response '''
+		handler = self.route_request(request)
+		try:
+			response = await handler(request)
+		except ApricotBodyTooLarge:
+			return ApricotResponse(status=413)
+		except Exception as exc:
+			return await self.default_500(request, exc)
+
+		# None turns into a 404, async iterables are streamed
+		if response is None or isinstance(response, ApricotResponse) \
+			or hasattr(response, '__aiter__'):
+			return response
+		return await self.default_500(request, TypeError(
+			"Handler returned %s, not an ApricotResponse" % type(response).__name__))
+
+	def coalesce_key(self, request):
+		''' key of identical requests, None when the request runs alone '''
+		route = request.route
+		if callable(route.coalesce):
+			return route.coalesce(request)
+		if request.method not in ('GET', 'HEAD'):
+			return None
+		return (request.method, request.path,
+			tuple(getHeader(request.headers, name) for name in route.vary))
+
+	async def coalesce(self, request, handler):
+		''' innermost layer of coalesced routes, identical concurrent requests
+		share one handler call but each runs its own middlewares
+		'''
+		key = self.coalesce_key(request)
+		if key is None:
+			return await handler(request)
+
+		# join the call in flight, streams and open files can only be sent once
+		flight = self.flights.get(key)
+		if flight is not None:
+			response = await asyncio.shield(flight)
+			if isinstance(response, ApricotResponse) and response.using not in ('stream', 'file'):
+				self.coalesced += 1
+
+				# a copy, middlewares may change the headers of their own response
+				response = copy.copy(response)
+				response.headers = ApricotHeaders(response.headers)
+				return response
+
+		flight   = asyncio.get_event_loop().create_future()
+		response = None
+		self.flights[key] = flight
+		try:
+			response = await handler(request)
+			return response
+		finally:
+			if self.flights.get(key) is flight:
+				del self.flights[key]
+			flight.set_result(response)
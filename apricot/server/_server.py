@@ -2,16 +2,54 @@
 #! python3
 
 import os, sys
+import signal
 import asyncio
 
 from ._router import ApricotRouter
+from ._workers import ApricotSupervisor
+from ._compression import ApricotCompression
+from ._admission import ApricotAdmission, ApricotAcceptor
+from ._timers import ApricotTimerWheel
+from ._metrics import ApricotMetrics
+from ._executors import ApricotExecutors
+from ._listeners import ApricotListener
 from ..client import ApricotClient
+from ..utils import DATE
 
 class ApricotServer(object):
 
-	def __init__(self, host="localhost", port=8080, loop=None):
+	def __init__(self, host="localhost", port=8080, loop=None,
+		keep_alive=True, keep_alive_timeout=5.0, max_requests=100,
+		clientObj=None, workers=1, shutdown_timeout=10.0, compression=None,
+		max_body_size=64 * 1024 * 1024, max_connections=None, max_inflight=None,
+		retry_after=1, pause_queue_depth=None, pause_loop_lag=None,
+		header_timeout=10.0, body_timeout=30.0, metrics=None, executors=None,
+		unix=None, sock=None, listeners=None):
 		''' create Apricot Server
 		@param port : port to host server on
+		@param unix : path of a Unix domain socket to listen on instead
+		@param sock : listening socket or file descriptor to accept on instead,
+			ApricotListener.systemd() gives the ones of socket activation
+		@param listeners : several of (host, port), Unix socket paths, sockets,
+			file descriptors or ApricotListener to accept on at once
+		@param workers : processes forked by run_workers()
+		@param shutdown_timeout : seconds a worker waits for open connections
+		@param compression : True or an ApricotCompression to gzip/deflate responses
+		@param metrics : True or an ApricotMetrics to collect request metrics
+		@param executors : ApricotExecutors with the pools of executor= routes
+		@param max_body_size : largest request body in bytes, bigger ones get a 413
+		@param max_connections : open connections, more get a 503 and are closed
+		@param max_inflight : requests handled at once, more get a 503
+		@param retry_after : seconds sent in Retry-After with a 503
+		@param pause_queue_depth : stop accepting while this many requests are handled
+		@param pause_loop_lag : stop accepting while the event loop runs this many seconds late
+		@param clientObj : connection engine, ApricotClient (streams) or
+			an asyncio.Protocol such as ApricotConnection
+		@param keep_alive : allow persistent HTTP/1.1 connections
+		@param keep_alive_timeout : seconds an idle connection is kept open
+		@param header_timeout : seconds a client has to send a request head
+		@param body_timeout : seconds a request body may stall between reads
+		@param max_requests : requests served per connection before closing
 		'''
 
 		# event loop
@@ -26,11 +64,59 @@ class ApricotServer(object):
 		self.running    = False
 		self.canRun     = True
 		self.isClosed   = False
+		self.closing    = False # shutting down, connections end after their request
+
+		# connection settings
+		self.keep_alive         = keep_alive
+		self.keep_alive_timeout = keep_alive_timeout
+		self.max_requests       = max_requests
+		self.max_body_size      = max_body_size
+
+		# read deadlines per phase, enforced by one shared timer wheel
+		self.timers    = ApricotTimerWheel()
+		self.timeouts  = {
+			"idle"  : keep_alive_timeout,
+			"header": header_timeout,
+			"body"  : body_timeout
+		}
+		self.timed_out = dict.fromkeys(self.timeouts, 0) # connections closed per phase
+
+		# load shedding
+		self.admission = ApricotAdmission(max_connections, max_inflight,
+			retry_after, pause_queue_depth, pause_loop_lag)
+
+		# worker settings
+		self.workers          = workers
+		self.shutdown_timeout = shutdown_timeout
+
+		# response compression
+		if compression is True:
+			compression = ApricotCompression()
+		self.compression = compression or None
+
+		# pools for blocking handlers
+		self.executors = executors if executors is not None else ApricotExecutors()
+
+		# request metrics, router.add_metrics() serves them
+		self.metrics = None
+		if metrics:
+			self.enable_metrics(None if metrics is True else metrics)
+
+		# listening addresses, every one is served the same way
+		if listeners is not None:
+			listeners = [ApricotListener.create(spec) for spec in listeners]
+		elif unix is not None:
+			listeners = [ApricotListener.unix(unix)]
+		elif sock is not None:
+			listeners = [ApricotListener.inherit(sock)]
+		else:
+			listeners = [ApricotListener.tcp(host, port)]
+		self.listeners = listeners
 
 		# server objects
-		self.server     = None
+		self.servers    = [] # one asyncio server or ApricotAcceptor per listener
 		self.clients    = {}
-		self.clientObj  = ApricotClient
+		self.clientObj  = clientObj if clientObj is not None else ApricotClient
 
 		# create router
 		self.router     = ApricotRouter(self)
@@ -47,21 +133,30 @@ class ApricotServer(object):
 		''' start apricot server '''
 		if self.canRun:
 
-			# create server coroutine
-			# modified to work on unix server
-			coro = asyncio.start_server(self.accept_client, 
-				port=self.port, host=self.host, loop=self.loop,
-				family=socket.AF_INET, flags=0,
-				reuse_port=True, reuse_address=True
-				)
+			self.admission.start(self.loop)
+			self.timers.start(self.loop)
 
-			# get socket server from coroutine
-			self.server = self.loop.run_until_complete(coro)
+			# an own accept loop when accepting may be paused
+			for listener in self.listeners:
+				sock = listener.bind()
+				if self.admission.pausable:
+					self.servers.append(ApricotAcceptor(self, sock))
+				else:
+					self.servers.append(self.loop.run_until_complete(
+						self.loop.create_server(self.make_protocol, sock=sock)))
+
+			# refresh the cached Date header from the loop
+			DATE.start(self.loop)
 
 			# server is started
-			print("Server stated on: {0}:{1}".format(self.host, self.port))
+			print("Server stated on: {0}".format(', '.join(map(str, self.listeners))))
 			self.running = True
 
+	@property
+	def server(self):
+		''' the asyncio server of the first listener '''
+		return self.servers[0] if self.servers else None
+
 	def wait_until_stopped(self):
 		''' wait until server is stopped '''
 		if not self.running or not self.canRun: return
@@ -71,22 +166,94 @@ class ApricotServer(object):
 			except KeyboardInterrupt:
 				return
 
+	def enable_metrics(self, metrics=None):
+		''' start collecting metrics, returns the ApricotMetrics in use '''
+		if self.metrics is None:
+			self.metrics = metrics if metrics is not None else ApricotMetrics()
+			self.metrics.add_gauge('apricot_connections',
+				'Open connections', lambda: len(self.clients))
+			self.metrics.add_gauge('apricot_inflight_requests',
+				'Requests being handled', lambda: self.admission.inflight)
+			self.metrics.add_gauge('apricot_thread_pool_queued',
+				'Thread pool calls waiting for a worker', lambda: self.executors.queued('thread'))
+			self.metrics.add_gauge('apricot_process_pool_queued',
+				'Process pool calls waiting for a worker', lambda: self.executors.queued('process'))
+		return self.metrics
+
+	def add_middleware(self, middleware):
+		''' add a global middleware, coroutine (request, handler) -> response '''
+		self.router.add_middleware(middleware)
+
+	def run_workers(self, workers=None):
+		''' fork worker processes sharing the port and supervise them '''
+		if workers is not None:
+			self.workers = workers
+
+		# Unix and inherited sockets are bound here and shared by the workers
+		for listener in self.listeners:
+			if listener.shared:
+				listener.bind()
+		try:
+			ApricotSupervisor(self, self.workers).run()
+		finally:
+			for listener in self.listeners:
+				listener.close()
+
+	def serve_worker(self):
+		''' run this server inside a forked worker until SIGTERM/SIGINT '''
+
+		# the parent loop must not be shared across a fork
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+
+		self.start()
+		for sig in (signal.SIGTERM, signal.SIGINT):
+			self.loop.add_signal_handler(sig, self.loop.stop)
+		self.loop.run_forever()
+
+		# coordinated shutdown
+		self.loop.run_until_complete(self.shutdown())
+		self.stop()
+
+	async def shutdown(self):
+		''' stop accepting and give open connections time to finish '''
+		self.keep_alive = False
+		self.closing    = True
+		for server in self.servers:
+			server.close()
+		self.servers = []
+
+		# idle keep-alive connections would only wait for keep_alive_timeout
+		for client, _, _ in list(self.clients.values()):
+			if client.idle and client.transport is not None:
+				client.transport.close()
+
+		tasks = list(self.clients)
+		if tasks:
+			await asyncio.wait(tasks, timeout=self.shutdown_timeout)
+
 	def stop(self):
 		''' close apricot server '''
 		if self.isClosed: return
 
 		# wait for all connections to close
-		if self.server is not None:
-			self.server.close()
+		for server in self.servers:
+			server.close()
 			self.loop.run_until_complete(
-				self.server.wait_closed())
-			self.server = None
+				server.wait_closed())
+		self.servers = []
+		for listener in self.listeners:
+			listener.close()
 
 		# wait for all tasks to close
 		#for task in asyncio.Task.all_tasks(self.loop):
 		#	task.cancel()
 
 		# close ApricotServer
+		DATE.stop()
+		self.admission.stop()
+		self.timers.stop()
+		self.executors.shutdown()
 		self.running  = False
 		self.canRun   = False
 		self.isClosed = True
@@ -94,9 +261,21 @@ class ApricotServer(object):
 
 	#### Server Functions ####
 
+	def make_protocol(self):
+		''' protocol for one accepted connection '''
+		if issubclass(self.clientObj, asyncio.Protocol):
+			return self.clientObj(self)
+		reader = asyncio.StreamReader(limit=2 ** 16)
+		return asyncio.StreamReaderProtocol(reader, self.accept_client)
+
 	async def accept_client(self, reader, writer):
 		''' handle requests for new clients '''
 
+		# shed connections over the limit
+		if not self.admission.admit_connection(self.clients):
+			await self.admission.shed(reader, writer)
+			return
+
 		# create a new client and task
 		new_client = self.clientObj(reader, writer, self)
 		new_task = asyncio.Task(new_client.start())
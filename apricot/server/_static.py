@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#! python3
+
+import os
+import time
+import mimetypes
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from ..client import ApricotResponse, ApricotFileResponse
+from ..utils import getHeader
+
+class ApricotStatic(object):
+	''' Serve files below a directory
+
+	Bodies are sent by the connection with loop.sendfile when the transport
+	allows it. Stat results and ETags of hot files are kept for a short
+	time so repeated requests skip the filesystem until the file is opened.
+	The file is opened before the response is returned, so a file removed
+	meanwhile is a 404 and one changed meanwhile is stat'ed again.
+	'''
+
+	def __init__(self, directory, cache_size=1024, cache_ttl=1.0):
+		self.directory  = os.path.realpath(directory)
+		self.cache_size = cache_size
+		self.cache_ttl  = cache_ttl
+		self.cache      = OrderedDict() # path -> (expires, stat, etag, last_modified)
+
+	async def __call__(self, request):
+		return self.respond(request)
+
+	def respond(self, request, fresh=False):
+		path = self.resolve(request.match_info.get('filename', ''))
+		if path is None:
+			return ApricotResponse(status=404)
+
+		if fresh:
+			self.cache.pop(path, None)
+		info = self.stat(path)
+		if info is None:
+			return ApricotResponse(status=404)
+		st, etag, last_modified = info
+
+		headers = {
+			'ETag'         : etag,
+			'Last-Modified': last_modified,
+			'Accept-Ranges': 'bytes'
+		}
+
+		# conditional requests
+		if self.not_modified(request, st, etag):
+			response = ApricotResponse(status=304, headers=headers)
+			response.headers.pop('Content-Length', None)
+			return response
+
+		# range requests, an If-Range that does not match sends everything
+		ranges = None
+		header = getHeader(request.headers, 'Range')
+		if header is not None:
+			if_range = getHeader(request.headers, 'If-Range')
+			if if_range is None or if_range == etag:
+				ranges = self.parse_range(header, st.st_size)
+				if ranges == []:
+					headers['Content-Range'] = 'bytes */%d' % st.st_size
+					return ApricotResponse(status=416, headers=headers)
+
+		# HEAD requests get the headers only
+		f = None
+		if request.method != 'HEAD':
+			try:
+				f = open(path, 'rb')
+			except OSError:
+				self.cache.pop(path, None)
+				return ApricotResponse(status=404)
+
+			# replaced since it was stat'ed, answer from the file opened
+			current = os.fstat(f.fileno())
+			if not fresh and (current.st_size, current.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+				f.close()
+				return self.respond(request, True)
+
+		content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+		return ApricotFileResponse(path, st.st_size, ranges,
+			headers=headers, content_type=content_type, file=f)
+
+	def resolve(self, filename):
+		''' map a url path onto a file, refusing anything outside the root '''
+		filename = filename.lstrip('/') # decoded by the route tree
+		try:
+			path = os.path.realpath(os.path.join(self.directory, filename))
+		except ValueError:
+			return None # e.g. an embedded null byte
+		if path != self.directory and not path.startswith(self.directory + os.sep):
+			return None
+		return path
+
+	def stat(self, path):
+		''' get (stat, etag, last modified), cached for cache_ttl seconds '''
+		now   = time.monotonic()
+		entry = self.cache.get(path)
+		if entry is not None and entry[0] > now:
+			self.cache.move_to_end(path)
+			return entry[1:]
+
+		try:
+			st = os.stat(path)
+		except OSError:
+			self.cache.pop(path, None)
+			return None
+		if not os.path.isfile(path):
+			return None
+
+		etag          = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+		last_modified = formatdate(st.st_mtime, usegmt=True)
+		self.cache[path] = (now + self.cache_ttl, st, etag, last_modified)
+		self.cache.move_to_end(path)
+		if len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+		return st, etag, last_modified
+
+	def not_modified(self, request, st, etag):
+		''' check If-None-Match, then If-Modified-Since '''
+		match = getHeader(request.headers, 'If-None-Match')
+		if match is not None:
+			tags = [tag.strip() for tag in match.split(',')]
+			return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+		since = getHeader(request.headers, 'If-Modified-Since')
+		if since is not None:
+			try:
+				return int(st.st_mtime) <= parsedate_to_datetime(since).timestamp()
+			except (TypeError, ValueError):
+				return False
+		return False
+
+	def parse_range(self, header, size):
+		''' parse a bytes Range header into [(start, end)], inclusive
+
+		Returns None for a header that is ignored and [] when no range can
+		be satisfied.
+		'''
+		unit, _, spec = header.partition('=')
+		if unit.strip().lower() != 'bytes' or not spec:
+			return None
+
+		ranges = []
+		for part in spec.split(','):
+			start, sep, end = part.strip().partition('-')
+			if not sep:
+				return None
+			try:
+				if start == '':
+					# suffix range, the last n bytes
+					length = int(end)
+					if length <= 0: continue
+					ranges.append((max(size - length, 0), size - 1))
+					continue
+				start = int(start)
+				end   = int(end) if end != '' else size - 1
+			except ValueError:
+				return None
+			if start >= size:
+				continue
+			if start > end:
+				return None
+			ranges.append((start, min(end, size - 1)))
+		return ranges
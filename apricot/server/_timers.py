@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#! python3
+
+import math
+import asyncio
+
+class ApricotTimerWheel(object):
+	''' Hashed timing wheel shared by every connection of a server
+
+	An entry is any object with deadline and timer_slot attributes and an
+	on_timeout() method. It sits in the slot of its deadline and the wheel
+	looks at one slot per tick, so there is one loop timer for the whole
+	server. Pushing a deadline later only updates the number, the entry is
+	moved when its old slot comes round, which keeps per read re-arming cheap.
+	'''
+
+	def __init__(self, resolution=0.25, size=512):
+		self.resolution = resolution
+		self.size       = size
+		self.slots      = [set() for _ in range(size)]
+		self.current    = None # last tick processed
+		self.loop       = None
+		self.handle     = None
+
+	def start(self, loop):
+		self.loop    = loop
+		self.current = math.floor(loop.time() / self.resolution)
+		self.schedule_tick()
+
+	def stop(self):
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+
+	def tick_of(self, deadline):
+		return math.ceil(deadline / self.resolution)
+
+	def schedule(self, entry, deadline):
+		''' expire entry at deadline, loop.time() based '''
+		if self.handle is None:
+			self.start(asyncio.get_event_loop())
+		if entry.timer_slot is not None:
+			if deadline >= entry.deadline:
+				entry.deadline = deadline
+				return
+			self.slots[entry.timer_slot].discard(entry)
+
+		entry.deadline   = deadline
+		entry.timer_slot = self.slot_of(deadline)
+		self.slots[entry.timer_slot].add(entry)
+
+	def cancel(self, entry):
+		if entry.timer_slot is not None:
+			self.slots[entry.timer_slot].discard(entry)
+			entry.timer_slot = None
+		entry.deadline = None
+
+	def slot_of(self, deadline):
+		tick = self.tick_of(deadline)
+		if self.current is not None and tick <= self.current:
+			tick = self.current + 1
+		return tick % self.size
+
+	def schedule_tick(self):
+		''' fire just past the next boundary, entries run at most one resolution late '''
+		when = (self.current + 1) * self.resolution + 0.001
+		self.handle = self.loop.call_at(when, self.tick)
+
+	def tick(self):
+		''' expire due entries of every slot passed since the last tick '''
+		try:
+			now = self.loop.time()
+			end = math.floor(now / self.resolution)
+
+			while self.current < end:
+				self.current += 1
+				position = self.current % self.size
+				slot     = self.slots[position]
+				if not slot: continue
+
+				for entry in list(slot):
+					if entry.timer_slot != position:
+						continue # cancelled by an earlier on_timeout()
+					if entry.deadline <= now:
+						slot.discard(entry)
+						entry.timer_slot = None
+						entry.deadline   = None
+						entry.on_timeout()
+					else:
+						# pushed later, or due on a later turn of the wheel
+						index = self.slot_of(entry.deadline)
+						if index != entry.timer_slot:
+							slot.discard(entry)
+							entry.timer_slot = index
+							self.slots[index].add(entry)
+		finally:
+			self.schedule_tick()
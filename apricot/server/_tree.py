@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#! python3
+
+import re
+from ..utils import unquote
+
+class ApricotInvalidRoute(Exception): pass
+
+# plain decimal numbers only, int() and float() also take 1_000, nan or inf
+INT_PATTERN   = re.compile(r'-?[0-9]+\Z')
+FLOAT_PATTERN = re.compile(r'-?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?\Z')
+
+def toInt(value):
+	if INT_PATTERN.match(value) is None:
+		raise ValueError("Not an integer: %r" % value)
+	return int(value)
+
+def toFloat(value):
+	if FLOAT_PATTERN.match(value) is None:
+		raise ValueError("Not a number: %r" % value)
+	return float(value)
+
+# path parameter converters, {name:type}
+CONVERTERS = {
+	"str"  : str,
+	"int"  : toInt,
+	"float": toFloat,
+	"path" : str
+}
+
+class ApricotRouteNode(object):
+	''' one path segment of the route tree '''
+
+	def __init__(self):
+		self.static   = {}   # segment -> ApricotRouteNode
+		self.params   = []   # [name, converter, ApricotRouteNode]
+		self.catchall = None # [name, handlers] for {name:path}
+		self.handlers = None # method -> callback
+
+class ApricotRouteTree(object):
+	''' Radix tree of routes split on path segments
+
+	Static paths are also kept in a flat dict so most lookups are a single
+	hash probe. Dynamic paths walk one node per segment, so the lookup cost
+	depends on the path depth and not on the number of routes. Parameter
+	values are percent-decoded before they are converted.
+	'''
+
+	def __init__(self):
+		self.root   = ApricotRouteNode()
+		self.static = {} # path -> method -> callback
+
+	##### Compiling #####
+
+	def add(self, path, method, callback):
+		''' compile a route into the tree '''
+		if not path.startswith('/'):
+			raise ApricotInvalidRoute("Route must start with '/': " + path)
+		handlers = self.node_for(path)
+		handlers[method] = callback
+
+	def node_for(self, path):
+		''' get the handler dict for a path, creating nodes as needed '''
+
+		# static fast path
+		if '{' not in path:
+			if path not in self.static:
+				self.static[path] = {}
+			return self.static[path]
+
+		node     = self.root
+		segments = path[1:].split('/')
+		for pos, segment in enumerate(segments):
+
+			# static segment
+			if not segment.startswith('{'):
+				if segment not in node.static:
+					node.static[segment] = ApricotRouteNode()
+				node = node.static[segment]
+				continue
+
+			# parameter segment
+			if not segment.endswith('}'):
+				raise ApricotInvalidRoute("Bad parameter in route: " + path)
+			name, _, kind = segment[1:-1].partition(':')
+			kind = kind or 'str'
+			if kind not in CONVERTERS:
+				raise ApricotInvalidRoute("Unknown parameter type: " + kind)
+
+			# {name:path} swallows the rest of the path
+			if kind == 'path':
+				if pos != len(segments) - 1:
+					raise ApricotInvalidRoute("{path} must be last: " + path)
+				if node.catchall is None:
+					node.catchall = [name, {}]
+				return node.catchall[1]
+
+			# reuse an existing node for the same parameter
+			child = None
+			for param in node.params:
+				if param[0] == name and param[1] is CONVERTERS[kind]:
+					child = param[2]
+					break
+			if child is None:
+				child = ApricotRouteNode()
+				node.params.append([name, CONVERTERS[kind], child])
+
+				# typed parameters are tried before plain strings
+				node.params.sort(key=lambda p: p[1] is str)
+			node = child
+
+		if node.handlers is None:
+			node.handlers = {}
+		return node.handlers
+
+	##### Lookup #####
+
+	def find(self, path):
+		''' get (handlers, params) for a path, or (None, None) '''
+		handlers = self.static.get(path)
+		if handlers:
+			return handlers, {}
+
+		params   = {}
+		handlers = self.match(self.root, path[1:].split('/'), 0, params)
+		if handlers is None:
+			return None, None
+		return handlers, params
+
+	def match(self, node, segments, pos, params):
+		''' walk the tree, backtracking when a branch does not match '''
+		if pos == len(segments):
+			return node.handlers
+
+		segment = segments[pos]
+
+		# static children win over parameters
+		child = node.static.get(segment)
+		if child is not None:
+			handlers = self.match(child, segments, pos + 1, params)
+			if handlers is not None:
+				return handlers
+
+		# typed, then string parameters
+		if segment != '' and node.params:
+			decoded = unquote(segment) if '%' in segment else segment
+			for name, converter, child in node.params:
+				try:
+					value = converter(decoded)
+				except ValueError:
+					continue
+				params[name] = value
+				handlers = self.match(child, segments, pos + 1, params)
+				if handlers is not None:
+					return handlers
+				del params[name]
+
+		# catch-all parameter
+		if node.catchall is not None:
+			params[node.catchall[0]] = '/'.join(unquote(part) for part in segments[pos:])
+			return node.catchall[1]
+
+		return None
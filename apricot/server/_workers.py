@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#! python3
+
+import os
+import sys
+import time
+import signal
+import traceback
+
+class ApricotWorkerError(Exception): pass
+
+class ApricotSupervisor(object):
+	''' Pre-fork supervisor for ApricotServer workers
+
+	Each worker is a forked process running its own event loop and
+	binding the same port with SO_REUSEPORT, so the kernel spreads
+	connections across them. Crashed workers are restarted, SIGTERM and
+	SIGINT are forwarded to every worker for a coordinated shutdown.
+	Workers failing at startup print their traceback, after max_failures
+	of those in a row they are no longer restarted.
+	'''
+
+	# workers dying sooner than this after a fork are restarted with a delay
+	min_uptime    = 1.0
+	restart_delay = 1.0
+	max_failures  = 5
+
+	def __init__(self, server, workers):
+		if not hasattr(os, 'fork'):
+			raise ApricotWorkerError("Worker mode needs os.fork")
+		if workers < 1:
+			raise ApricotWorkerError("At least one worker is required")
+
+		self.server   = server
+		self.workers  = workers
+		self.children = {} # pid -> spawn time
+		self.stopping = False
+		self.failures = 0  # startup failures in a row
+
+	def run(self):
+		''' fork the workers and supervise them until shutdown '''
+		previous = {}
+		for sig in (signal.SIGTERM, signal.SIGINT):
+			previous[sig] = signal.signal(sig, self.on_signal)
+
+		try:
+			for _ in range(self.workers):
+				self.spawn()
+			self.supervise()
+			if self.failures >= self.max_failures:
+				raise ApricotWorkerError("Workers failed to start %d times in a row" % self.failures)
+		finally:
+			for sig in previous:
+				signal.signal(sig, previous[sig])
+
+	def spawn(self):
+		''' fork a single worker process '''
+		pid = os.fork()
+		if pid == 0:
+			code = 0
+			try:
+				for sig in (signal.SIGTERM, signal.SIGINT):
+					signal.signal(sig, signal.SIG_DFL)
+				self.server.serve_worker()
+			except BaseException:
+				code = 1
+				traceback.print_exc()
+			finally:
+				sys.stdout.flush()
+				sys.stderr.flush()
+				os._exit(code)
+		self.children[pid] = time.monotonic()
+		return pid
+
+	def supervise(self):
+		''' reap workers, restarting the ones that crashed '''
+		while self.children:
+			try:
+				pid, status = os.wait()
+			except ChildProcessError:
+				break
+			started = self.children.pop(pid, None)
+			if started is None or self.stopping:
+				continue
+
+			# a clean exit is not a crash
+			if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+				continue
+
+			# restart, with a delay when it keeps dying on startup
+			if time.monotonic() - started < self.min_uptime:
+				self.failures += 1
+				if self.failures >= self.max_failures:
+					print("Worker %d failed at startup %d times in a row, not restarting it"
+						% (pid, self.failures), file=sys.stderr)
+					continue
+				time.sleep(self.restart_delay)
+			else:
+				self.failures = 0
+			if not self.stopping:
+				self.spawn()
+
+	def on_signal(self, signum, frame):
+		''' forward shutdown to all workers '''
+		self.stopping = True
+		for pid in list(self.children):
+			try: os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError: pass
@@ -6,7 +6,9 @@ import io
 import gzip
 import time
 import binascii
+from email.utils import formatdate
 from ._url import ApricotUrl
+from ._headers import ApricotHeaders
 from .. import __version__
 from urllib.parse import unquote, quote_plus as quote
 from urllib.parse import urlencode, parse_qs, urlparse
@@ -26,6 +28,7 @@ _BREAK    = BREAK.encode()
 END_BREAK = _BREAK + _BREAK
 CHUNKED   = b"Transfer-Encoding: chunked"
 CHUNK_END = b'0' + _BREAK + _BREAK
+CONTINUE  = b'HTTP/1.1 100 Continue' + END_BREAK
 CLEN      = "Content-Length"
 _CLEN     = CLEN.encode()
 
@@ -73,8 +76,7 @@ CODES   = {
 }
 
 RESPONSE_HEADERS = {
-	"Server"       : "Apricot-HTTP-Server/" + __version__,
-	"Connection"   : "close"
+	"Server"       : "Apricot-HTTP-Server/" + __version__
 }
 
 REQUEST_HEADERS = {
@@ -111,52 +113,147 @@ def createParams(params):
 	else:
 		return ''
 
-def createHeaders(resp=b'', headers=None):
-	# set default headers
-	_headers = RESPONSE_HEADERS.copy()
-	_headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime())
+# status lines are encoded once, 'HTTP/1.1 200 OK\r\n'
+STATUS_LINES = {}
+for _code in CODES:
+	STATUS_LINES[int(_code)] = ('HTTP/1.1 ' + _code + ' ' + CODES[_code] + BREAK).encode()
 
-	# get headers
-	if headers is not None:
-		for key in headers:
-			_headers[key] = headers[key]
+CONNECTION_LINES = {
+	True : b'Connection: keep-alive' + _BREAK,
+	False: b'Connection: close' + _BREAK
+}
+
+def defaultHeaderLines():
+	''' encode RESPONSE_HEADERS, call again after changing them '''
+	global DEFAULT_HEADER_LINES
+	DEFAULT_HEADER_LINES = ''.join(
+		head + ": " + RESPONSE_HEADERS[head] + BREAK for head in RESPONSE_HEADERS).encode()
+	return DEFAULT_HEADER_LINES
+
+DEFAULT_HEADER_LINES = defaultHeaderLines()
+
+class ApricotDate(object):
+	''' Cached Date header line
+
+	A running server refreshes it from its loop once per second, without a
+	loop it is rebuilt whenever the second changes.
+	'''
+
+	def __init__(self):
+		self.second = None
+		self.line   = b''
+		self.handle = None
+		self.loop   = None
+		self.update()
 
-	# build string
-	for head in _headers:
-		resp += (head + ": " + str(_headers[head]) + BREAK).encode()
-	resp += BREAK.encode()
+	def update(self):
+		now = int(time.time())
+		if now != self.second:
+			self.second = now
+			self.line   = ('Date: ' + formatdate(now, usegmt=True) + BREAK).encode()
+		return self.line
 
-	return resp
+	def get(self):
+		if self.handle is None or self.loop.is_closed():
+			return self.update()
+		return self.line
+
+	def start(self, loop):
+		''' refresh the date from a loop every second '''
+		if self.handle is not None and self.loop is loop:
+			return
+		self.stop()
+		self.loop = loop
+		self.tick(loop)
+
+	def tick(self, loop):
+		self.update()
+		self.handle = loop.call_later(1.0 - time.time() % 1.0, self.tick, loop)
+
+	def stop(self):
+		if self.handle is not None:
+			self.handle.cancel()
+			self.handle = None
+
+DATE = ApricotDate()
 
 def makeResponse(code=200):
-	# get code and reason
-	if str(code) not in CODES:
-		code = 404
-	reason = CODES[str(code)]
-	return ('HTTP/1.1 ' + str(code) + ' ' + reason + BREAK).encode()
+	''' get the encoded status line of a code '''
+	line = STATUS_LINES.get(code)
+	if line is None:
+		code = int(code)
+		line = STATUS_LINES.get(code)
+		if line is None:
+			line = ('HTTP/1.1 %d Unknown' % code + BREAK).encode()
+			STATUS_LINES[code] = line
+	return line
 
-def createResponse(response):
-	''' Create an HTTP Response byte string from ApricotResponse '''
-	resp = makeResponse(response.status)
-	resp = createHeaders(resp, response.headers)
-	if isinstance(resp, str): resp = resp.encode()
+def createHead(code=200, headers=None, keep_alive=False, lines=None):
+	''' Create the status line and header block as one byte string
+	@param lines : headers already encoded with createHeaderLines()
+	'''
+	parts = [makeResponse(code)]
 
-	# add response data
-	if response.using != 'body':
-		resp += response.text.encode()
-	else:
-		if response.body is not None:
-			if response.headers is not None:
-				if 'Content-Length' in response.headers:
-					body = response.body
-					body = body if isinstance(body, bytes) else body.encode()
-					resp += body
-
-	# encode to correct charset
-	resp = resp.decode()
-	if response.charset is not None:
-		resp = resp.encode(response.charset)
+	# default headers, unless a response overrides them
+	if not headers:
+		parts += [DEFAULT_HEADER_LINES, DATE.get(), CONNECTION_LINES[bool(keep_alive)], _BREAK]
+		return b''.join(parts)
+
+	names = headers.names if headers.__class__ is ApricotHeaders else None
+	if names is not None:
+		if 'server' not in names: parts.append(DEFAULT_HEADER_LINES)
+		if 'date' not in names: parts.append(DATE.get())
+		if 'connection' not in names: parts.append(CONNECTION_LINES[bool(keep_alive)])
 	else:
-		resp = resp.encode()
+		if 'Server' not in headers: parts.append(DEFAULT_HEADER_LINES)
+		if 'Date' not in headers: parts.append(DATE.get())
+		if 'Connection' not in headers: parts.append(CONNECTION_LINES[bool(keep_alive)])
+	parts.append(lines if lines is not None else createHeaderLines(headers))
+	parts.append(_BREAK)
+	return b''.join(parts)
+
+def createHeaderLines(headers):
+	''' encode a header dict or ApricotHeaders as header lines '''
+	if headers.__class__ is ApricotHeaders:
+		return ''.join([entry[0] + ": " + (value.decode('utf-8', 'replace')
+			if value.__class__ is bytes else str(value)) + BREAK
+			for entry in headers.names.values() for value in entry[1:]]).encode()
+	return ''.join([head + ": " + str(headers[head]) + BREAK for head in headers]).encode()
+
+def createHeaders(resp=b'', headers=None, keep_alive=False):
+	''' append the header block to a status line '''
+	head = createHead(200, headers, keep_alive)
+	return resp + head[head.index(_BREAK) + 2:]
+
+def getHeader(headers, name, default=None):
+	''' case-insensitive header lookup '''
+	if isinstance(headers, ApricotHeaders):
+		return headers.get(name, default)
+	if name in headers:
+		return headers[name]
+	name = name.lower()
+	for key in headers:
+		if key.lower() == name:
+			return headers[key]
+	return default
 
-	return resp
\ No newline at end of file
+def createChunk(data):
+	''' frame bytes as one chunk of a chunked body '''
+	return ('%x' % len(data) + BREAK).encode(), data, _BREAK
+
+def createResponseParts(response, keep_alive=False, head=False):
+	''' Create (head, body) byte strings from ApricotResponse
+
+	The two parts are meant for writelines so large bodies are never
+	copied into the header buffer.
+	'''
+	data = createHead(response.status, response.headers, keep_alive)
+
+	# HEAD responses only carry the headers, streams and files send their own
+	if head or response.using in ('stream', 'file'):
+		return data, b''
+	return data, response.payload or b''
+
+def createResponse(response, keep_alive=False, head=False):
+	''' Create an HTTP Response byte string from ApricotResponse '''
+	return b''.join(createResponseParts(response, keep_alive, head))
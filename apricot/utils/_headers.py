@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#! python3
+
+class ApricotHeaders(object):
+	''' Case-insensitive header mapping keeping every value of a name
+
+	Names are looked up by their lower case form in one dict. Values added
+	by the parser stay bytes until read. headers[name] and get() give the
+	first value of a name, getall() every value, pairs() every (name, value)
+	to serialize.
+	'''
+
+	__slots__ = ('names',)
+
+	def __init__(self, headers=None):
+		self.names = {} # lower name -> [name, value, ...]
+		if headers:
+			self.extend(headers)
+
+	##### Adding #####
+
+	def add(self, name, value):
+		''' add a value, earlier values of the name are kept '''
+		if isinstance(name, bytes): name = name.decode('latin-1')
+		key   = name.lower()
+		entry = self.names.get(key)
+		if entry is None:
+			self.names[key] = [name, value]
+		else:
+			entry.append(value)
+
+	def extend(self, headers):
+		''' add every value of a mapping, ApricotHeaders or (name, value) pairs '''
+		if isinstance(headers, ApricotHeaders):
+			for key, entry in headers.names.items():
+				current = self.names.get(key)
+				if current is None:
+					self.names[key] = list(entry)
+				else:
+					current.extend(entry[1:])
+			return
+		if hasattr(headers, 'items'):
+			headers = headers.items()
+		names = self.names
+		for name, value in headers:
+			if name.__class__ is bytes: name = name.decode('latin-1')
+			key   = name.lower()
+			entry = names.get(key)
+			if entry is None:
+				names[key] = [name, value]
+			else:
+				entry.append(value)
+
+	def copy(self):
+		return ApricotHeaders(self)
+
+	##### Lookup #####
+
+	@staticmethod
+	def decoded(entry, index):
+		''' value of an entry, bytes are decoded on first read '''
+		value = entry[index]
+		if isinstance(value, bytes):
+			value = entry[index] = value.decode('utf-8', 'replace')
+		return value
+
+	def __getitem__(self, name):
+		entry = self.names.get(name.lower())
+		if entry is None:
+			raise KeyError(name)
+		return self.decoded(entry, 1)
+
+	def get(self, name, default=None):
+		entry = self.names.get(name.lower())
+		if entry is None:
+			return default
+		return self.decoded(entry, 1)
+
+	def getall(self, name):
+		''' every value of a name, in the order received '''
+		entry = self.names.get(name.lower())
+		if entry is None:
+			return []
+		return [self.decoded(entry, index) for index in range(1, len(entry))]
+
+	def pairs(self):
+		''' [(name, value)] for every value '''
+		result = []
+		for entry in self.names.values():
+			name = entry[0]
+			for index in range(1, len(entry)):
+				value = entry[index]
+				if value.__class__ is bytes:
+					value = self.decoded(entry, index)
+				result.append((name, value))
+		return result
+
+	def __contains__(self, name):
+		try:
+			return name.lower() in self.names
+		except AttributeError:
+			return False
+
+	##### Mapping #####
+
+	def __setitem__(self, name, value):
+		''' replace every value of a name '''
+		self.names[name.lower()] = [name, value]
+
+	def __delitem__(self, name):
+		try:
+			del self.names[name.lower()]
+		except KeyError:
+			raise KeyError(name) from None
+
+	def pop(self, name, *default):
+		entry = self.names.pop(name.lower(), None)
+		if entry is None:
+			if default: return default[0]
+			raise KeyError(name)
+		return self.decoded(entry, 1)
+
+	def setdefault(self, name, default=None):
+		entry = self.names.get(name.lower())
+		if entry is None:
+			self[name] = default
+			return default
+		return self.decoded(entry, 1)
+
+	def update(self, headers):
+		''' replace the values of every name in headers '''
+		other = ApricotHeaders(headers)
+		self.names.update(other.names)
+
+	def keys(self):
+		return [entry[0] for entry in self.names.values()]
+
+	def values(self):
+		return [self.decoded(entry, 1) for entry in self.names.values()]
+
+	def items(self):
+		''' (name, first value) per name, see pairs() for every value '''
+		return [(entry[0], self.decoded(entry, 1)) for entry in self.names.values()]
+
+	def __iter__(self):
+		for entry in self.names.values():
+			yield entry[0]
+
+	def __len__(self):
+		return len(self.names)
+
+	def __bool__(self):
+		return bool(self.names)
+
+	def __eq__(self, other):
+		if isinstance(other, dict):
+			other = ApricotHeaders(other)
+		if not isinstance(other, ApricotHeaders):
+			return NotImplemented
+		return {key: self.getall(key) for key in self.names} == \
+			{key: other.getall(key) for key in other.names}
+
+	def __repr__(self):
+		return 'ApricotHeaders(%r)' % (self.pairs(),)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+#! python3
+
+import asyncio
+import unittest
+from apricot.client import ApricotRequest, ApricotResponse
+from apricot.server._router import ApricotRouter
+
+def request(token=None):
+	request = ApricotRequest()
+	request.path = '/s'
+	if token is not None:
+		request.headers.add('Authorization', token)
+	return request
+
+class TestCoalesce(unittest.TestCase):
+
+	def setUp(self):
+		self.calls  = 0
+		self.router = ApricotRouter(None)
+
+		async def auth(request, handler):
+			if request.headers.get('Authorization') != 'secret':
+				return ApricotResponse(status=401)
+			return await handler(request)
+
+		async def secret(request):
+			self.calls += 1
+			await asyncio.sleep(0.05)
+			return ApricotResponse(text='top secret')
+
+		self.router.add_get('/s', secret, coalesce=True, middlewares=[auth])
+
+	def run_requests(self, *requests):
+		async def run():
+			tasks = []
+			for request in requests:
+				tasks.append(asyncio.ensure_future(self.router.process_request(request)))
+				await asyncio.sleep(0.01)
+			return await asyncio.gather(*tasks)
+		return asyncio.run(run())
+
+	def test_follower_runs_middlewares(self):
+		leader, follower = self.run_requests(request('secret'), request())
+		self.assertEqual(leader.status, 200)
+		self.assertEqual(follower.status, 401)
+		self.assertEqual(self.router.coalesced, 0)
+
+	def test_followers_share_the_call(self):
+		responses = self.run_requests(request('secret'), request('secret'), request('secret'))
+		self.assertEqual([response.status for response in responses], [200, 200, 200])
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(self.router.coalesced, 2)
+
+	def test_follower_gets_its_own_headers(self):
+		leader, follower = self.run_requests(request('secret'), request('secret'))
+		follower.headers['X-Request-Id'] = 'req-2'
+		self.assertNotIn('X-Request-Id', leader.headers)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#! python3
+
+import unittest
+from apricot.client import ApricotRequest, ApricotResponse
+from apricot.server import ApricotCompression
+from apricot.server._compression import parseQualities
+
+def request(accept=None):
+	request = ApricotRequest()
+	if accept is not None:
+		request.headers.add('Accept-Encoding', accept)
+	return request
+
+class TestQualities(unittest.TestCase):
+
+	def test_default_q(self):
+		self.assertEqual(parseQualities('gzip, deflate'), {'gzip': 1.0, 'deflate': 1.0})
+
+	def test_q_values(self):
+		self.assertEqual(parseQualities('gzip;q=0.5, deflate; q=0.8, br'),
+			{'gzip': 0.5, 'deflate': 0.8, 'br': 1.0})
+
+	def test_other_params(self):
+		self.assertEqual(parseQualities('gzip;level=1;q=0.3'), {'gzip': 0.3})
+
+	def test_case_and_spaces(self):
+		self.assertEqual(parseQualities(' GZIP ; Q=0.2 ,'), {'gzip': 0.2})
+
+	def test_invalid_q_refuses(self):
+		self.assertEqual(parseQualities('gzip;q=abc, deflate;q=2'),
+			{'gzip': 0.0, 'deflate': 0.0})
+
+
+class TestNegotiate(unittest.TestCase):
+
+	def setUp(self):
+		self.compression = ApricotCompression()
+
+	def negotiate(self, accept=None):
+		return self.compression.negotiate(request(accept))
+
+	def test_no_header(self):
+		self.assertIsNone(self.negotiate())
+
+	def test_gzip_wins_ties(self):
+		self.assertEqual(self.negotiate('deflate, gzip'), 'gzip')
+
+	def test_highest_q(self):
+		self.assertEqual(self.negotiate('gzip;q=0.4, deflate;q=0.9'), 'deflate')
+
+	def test_q_zero_refuses(self):
+		self.assertIsNone(self.negotiate('gzip;q=0'))
+		self.assertEqual(self.negotiate('gzip;q=0, deflate'), 'deflate')
+
+	def test_star(self):
+		self.assertEqual(self.negotiate('*'), 'gzip')
+		self.assertIsNone(self.negotiate('*;q=0'))
+
+	def test_explicit_refusal_beats_star(self):
+		self.assertEqual(self.negotiate('gzip;q=0, *'), 'deflate')
+		self.assertIsNone(self.negotiate('gzip;q=0, deflate;q=0, *'))
+
+	def test_unknown_codings(self):
+		self.assertIsNone(self.negotiate('br, identity'))
+
+
+class TestVary(unittest.TestCase):
+
+	def setUp(self):
+		self.compression = ApricotCompression()
+
+	def apply(self, accept=None, **options):
+		return self.compression.apply(request(accept), ApricotResponse(text='x' * 5000, **options))
+
+	def test_compressed(self):
+		response = self.apply('gzip')
+		self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+		self.assertEqual(response.headers.get('Vary'), 'Accept-Encoding')
+
+	def test_merges_existing_vary(self):
+		response = self.apply('gzip', headers={'Vary': 'Origin'})
+		self.assertEqual(response.headers.getall('Vary'), ['Origin, Accept-Encoding'])
+
+	def test_no_duplicate(self):
+		response = self.apply('gzip', headers={'Vary': 'Origin, accept-encoding'})
+		self.assertEqual(response.headers.get('Vary'), 'Origin, accept-encoding')
+
+	def test_uncompressed_still_varies(self):
+		response = self.apply(headers={'Vary': 'Origin'})
+		self.assertIsNone(response.headers.get('Content-Encoding'))
+		self.assertEqual(response.headers.get('Vary'), 'Origin, Accept-Encoding')
+
+	def test_small_body_unchanged(self):
+		original = ApricotResponse(text='x')
+		self.assertIs(self.compression.apply(request('gzip'), original), original)
+		self.assertIsNone(original.headers.get('Vary'))
+
+
+if __name__ == '__main__':
+	unittest.main()